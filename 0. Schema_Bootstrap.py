@@ -0,0 +1,206 @@
+"""
+The code is dedicated for the schema bootstrap of the EKG pipeline. It declares every index
+and uniqueness constraint the later stages rely on and verifies with EXPLAIN that their hot
+lookups are planned as index seeks. It should be run before all other stages.
+"""
+
+from datetime import date, datetime
+from neo4j import GraphDatabase
+from dotenv import load_dotenv
+import argparse
+import os
+
+load_dotenv()
+
+# Uniqueness constraints, (name, label, property). A constraint that cannot be created because
+# the existing data violates it falls back to a plain index named {name}_fallback, which does not
+# collide with the constraint name the stages create. The run still fails at the end, the fallback
+# index has to be dropped and the duplicates resolved before the constraint can be created.
+CONSTRAINTS = [
+    ("run_id", "Run", "runId"),
+    ("resource_sys_id", "Resource", "sysId"),
+    ("batch_instance_key", "BatchInstance", "batch_key"),
+    ("high_level_batch_key", "HighLevelBatch", "batch_key"),
+]
+
+# Indexes, (name, label, property) or (name, label, (property, ...)) for a composite index
+INDEXES = [
+    ("batch_for_events", "Event", "batch"),
+    ("event_timestamp", "Event", "timestamp"),
+    ("batch_for_kits", "Kit", "kitId"),
+    ("batch_instance_batch_number", "BatchInstance", "batch_number"),
+    ("batch_instance_earliest_timestamp", "BatchInstance", "earliest_timestamp"),
+    ("task_instance_case", "TaskInstance", "cID"),
+    ("task_instance_resource", "TaskInstance", "rID"),
+    ("task_instance_path", "TaskInstance", "path"),
+    ("task_instance_id", "TaskInstance", "ID"),
+    ("task_instance_cluster", "TaskInstance", "cluster"),
+    ("task_instance_end_time", "TaskInstance", "end_time"),
+    ("task_instance_case_start_time", "TaskInstance", ("cID", "start_time")),
+    ("task_instance_resource_start_time", "TaskInstance", ("rID", "start_time")),
+    ("task_cluster_name", "TaskCluster", "Name"),
+    ("high_level_batch_date", "HighLevelBatch", "date"),
+]
+
+# Hot lookups of the pipeline, (stage, query, parameters), the query text as the stage runs it.
+# Each plan has to contain an index seek. EXPLAIN does not run the query, so writes are planned only.
+HOT_QUERIES = [
+    ("3.1 Query C", """
+    MATCH (ti:TaskInstance)
+    MATCH (n:Run) WHERE ti.cID = n.runId
+    RETURN ti,n
+    """, {}),
+    ("3.1 Query C 2 part", """
+    MATCH (ti:TaskInstance)
+    MATCH (n:Resource) WHERE  ti.rID = n.sysId
+    RETURN ti,n
+    """, {}),
+    ("3.1 incremental Query A", """
+    MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (e2:Event) WHERE e2.timestamp > w.timestamp
+    MATCH (e1:Event)-[:DF_RESOURCE]->(e2)
+    MATCH (e1)-[:DF_RUN]->(e2)
+    RETURN e1,e2
+    """, {}),
+    ("3.1 incremental Query D 2 part tail", """
+    MATCH (prev:TaskInstance) WHERE prev.cID = $run_id AND prev.start_time < $cut
+    WITH prev ORDER BY prev.start_time DESC, ID(prev) DESC LIMIT 1
+    RETURN COLLECT (prev) AS tail
+    """, {"run_id": "", "cut": datetime(2000, 1, 1)}),
+    ("3.1 incremental Query D 4 part tail", """
+    MATCH (prev:TaskInstance) WHERE prev.rID = $sys_id AND prev.start_time < $cut
+    WITH prev ORDER BY prev.start_time DESC, ID(prev) DESC LIMIT 1
+    RETURN COLLECT (prev) AS tail
+    """, {"sys_id": "", "cut": datetime(2000, 1, 1)}),
+    ("3.2 observed clusters", """
+    MATCH (ti:TaskInstance) WHERE ti.cluster IS NOT NULL
+    MATCH (tc:TaskCluster {Name:ti.cluster})
+    CREATE (ti)-[:TI_OBSERVED]->(tc)
+    """, {}),
+    ("3.2 DF_TC edges", """
+    UNWIND $rows AS row
+    MATCH (tc1:TaskCluster {Name:row.source})
+    MATCH (tc2:TaskCluster {Name:row.target})
+    CREATE (tc1)-[:DF_TC {EntityType:row.entity_type, count:row.count}]->(tc2)
+    """, {"rows": [{"source": ["start"], "target": ["end"], "entity_type": "case", "count": 1}]}),
+    ("3.3 cluster labels", """
+    UNWIND $rows AS row
+    MATCH (ti:TaskInstance {ID: row.task_id})
+    SET ti.cluster = row.path,
+        ti.clusterID = row.cluster_label
+    """, {"rows": [{"task_id": 1, "path": ["start"], "cluster_label": "Cluster_0"}]}),
+    ("4.3/5.3 partitions", """
+    MATCH (e:Event) WHERE e.batch >= $lower AND e.batch < $upper
+    MATCH (u:Resource)<-[:CORR]-(e)-[:CORR]->(k:Kit)
+    RETURN e
+    """, {"lower": 1, "upper": 5001}),
+    ("4.4/5.4 fresh Event CORR", """
+    MATCH (n:BatchInstance)
+    MATCH (e:Event {batch: n.batch_number}) CREATE (e)-[:CORR]->(n)
+    """, {}),
+    ("6.1 batch instances", """
+    MATCH (hlb:HighLevelBatch)
+    UNWIND hlb.corr_batch_numbers AS id_val MATCH (batch:BatchInstance) WHERE id_val = batch.batch_number MERGE (batch)-[:CORR]->(hlb)
+    """, {}),
+    ("6.1 batch instance days", """
+    MATCH (batch:BatchInstance)
+    WHERE (batch.earliest_timestamp >= $start_timestamp AND batch.earliest_timestamp < $end_timestamp)
+    RETURN batch
+    """, {"start_timestamp": datetime(2000, 1, 1), "end_timestamp": datetime(2000, 1, 2)}),
+    ("6.1 date range", """
+    MATCH (hlb:HighLevelBatch)
+    WHERE (hlb.date >= $start_date AND hlb.date <= $end_date)
+    RETURN hlb
+    """, {"start_date": date(2000, 1, 1), "end_date": date(2000, 1, 1)}),
+]
+
+class SchemaBootstrap:
+    def __init__(self, uri, username, password):
+        self.driver = GraphDatabase.driver(uri, auth=(username, password))
+
+    def close(self):
+        self.driver.close()
+
+    def create_schema(self):
+        # Every statement runs in its own transaction, schema and data writes cannot be mixed.
+        # Returns the constraints that were replaced by a fallback index.
+        fallbacks = []
+        with self.driver.session() as session:
+            for name, label, prop in CONSTRAINTS:
+                try:
+                    session.write_transaction(self._create_constraint, name, label, prop)
+                    print(f"Constraint {name} on {label}.{prop} created.")
+                except Exception as e:
+                    print(f"WARNING: constraint {name} on {label}.{prop} could not be created, "
+                          f"index {name}_fallback created instead: {e}")
+                    session.write_transaction(self._create_index, f"{name}_fallback", label, prop)
+                    fallbacks.append(name)
+            for name, label, prop in INDEXES:
+                session.write_transaction(self._create_index, name, label, prop)
+                print(f"Index {name} on {label}.{self._properties(prop)} created.")
+            # The planner only uses indexes once they are online
+            session.run("CALL db.awaitIndexes(600)").consume()
+            print("Indexes and constraints creation queries executed.")
+        return fallbacks
+
+    @staticmethod
+    def _create_constraint(tx, name, label, prop):
+        tx.run(f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE")
+
+    @staticmethod
+    def _create_index(tx, name, label, prop):
+        properties = (prop,) if isinstance(prop, str) else prop
+        tx.run(f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({', '.join('n.' + p for p in properties)})")
+
+    @staticmethod
+    def _properties(prop):
+        return prop if isinstance(prop, str) else "(" + ", ".join(prop) + ")"
+
+    def verify_index_usage(self):
+        # EXPLAIN plans every hot query without running it and looks for an index seek operator
+        missing = []
+        with self.driver.session() as session:
+            for stage, query, parameters in HOT_QUERIES:
+                plan = session.run(f"EXPLAIN {query}", parameters).consume().plan
+                operators = self._operators(plan)
+                if any("IndexSeek" in operator for operator in operators):
+                    print(f"{stage}: index seek used.")
+                else:
+                    print(f"{stage}: no index seek, plan uses {', '.join(operators)}.")
+                    missing.append(stage)
+        return missing
+
+    @classmethod
+    def _operators(cls, plan):
+        # Operator names of a plan tree, e.g. NodeIndexSeek@neo4j
+        operators = [plan["operatorType"]]
+        for child in plan.get("children", []):
+            operators += cls._operators(child)
+        return operators
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--skip-verify', action='store_true',
+                        help="only create the indexes and constraints")
+    args = parser.parse_args()
+
+    uri = os.getenv('NEO4J_URI')
+    username = os.getenv('NEO4J_USER')
+    password = os.getenv('NEO4J_PASSWORD')
+    bootstrap = SchemaBootstrap(uri, username, password)
+
+    try:
+        fallbacks = bootstrap.create_schema()
+        if not args.skip_verify:
+            missing = bootstrap.verify_index_usage()
+            if missing:
+                raise SystemExit(f"Hot queries without index seeks: {', '.join(missing)}")
+            print("All hot queries use index seeks.")
+        if fallbacks:
+            raise SystemExit(f"Constraints replaced by fallback indexes, drop the {{name}}_fallback indexes, "
+                             f"resolve the duplicates and run again: {', '.join(fallbacks)}")
+    finally:
+        bootstrap.close()
+
+if __name__ == "__main__":
+    main()
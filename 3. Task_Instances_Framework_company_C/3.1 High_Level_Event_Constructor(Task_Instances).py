@@ -8,6 +8,7 @@ knowledge graphs for task analysis." The link to the research paper
 
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
+import argparse
 import os
 
 # Define Neo4j connection details
@@ -29,21 +30,28 @@ queries = [
     {batchSize:100})
     """,
     """
-    // Query B
+    // Query B: one task instance per DF_JOINT path from a chain start to a chain end, as
+    // with matching all starts against all ends. Paths are expanded from each start only,
+    // stopping at the ends reachable from it, so branching chains still give one task
+    // instance per path and no prefix of a path is materialized.
     CALL apoc.periodic.iterate(
     "CALL {
     MATCH (e1:Event)-[:DF_JOINT]->() WHERE NOT ()-[:DF_JOINT]->(e1) 
-    MATCH ()-[:DF_JOINT]->(e2:Event) WHERE NOT (e2)-[:DF_JOINT]->() 
-    MATCH p=(e1)-[:DF_JOINT*]->(e2) 
-    RETURN p, e1, e2, NULL as caseID, NULL as resource 
+    WITH DISTINCT e1 
+    CALL apoc.path.subgraphNodes(e1, {relationshipFilter: 'DF_JOINT>'}) YIELD node 
+    WITH e1, node WHERE NOT (node)-[:DF_JOINT]->() 
+    WITH e1, collect(node) AS ends 
+    CALL apoc.path.expandConfig(e1, {relationshipFilter: 'DF_JOINT>', minLevel: 1, terminatorNodes: ends}) YIELD path 
+    WITH e1, nodes(path) AS events 
+    RETURN events, e1, last(events) AS e2, NULL as caseID, NULL as resource 
     UNION 
     MATCH (ur:Run)<-[:CORR]-(e:Event)-[:CORR]->(u:Resource) WHERE u.sysId IS NOT NULL 
     AND NOT ()-[:DF_JOINT]->(e) AND NOT (e)-[:DF_JOINT]->() 
-    MATCH p=(e) RETURN p, e AS e1, e AS e2, ur.runId as caseID, u.sysId as resource 
+    RETURN [e] AS events, e AS e1, e AS e2, ur.runId as caseID, u.sysId as resource 
     } 
-    RETURN [event in nodes(p) | event.activity] AS path,  
+    RETURN [event in events | event.activity] AS path,  
     resource AS resource, caseID AS caseID,  
-    nodes(p) AS events, e1.timestamp AS start_time, e2.timestamp AS end_time",
+    events, e1.timestamp AS start_time, e2.timestamp AS end_time",
     "WITH path, resource, caseID, events, start_time, end_time 
     CREATE (ti:TaskInstance {path:path, rID:resource, cID:caseID, start_time:start_time, end_time:end_time, r_count: 1, c_count: 1}) 
     WITH ti, events 
@@ -112,6 +120,249 @@ queries = [
     "WITH ti, rank 
     SET ti.ID = rank",
     {batchSize:100})
+    """,
+    """
+    // Query F: path frequencies and ranks kept for incremental runs
+    MATCH (tp:TaskPath)
+    DETACH DELETE tp
+    """,
+    """
+    // Query F 2 part
+    MATCH (ti:TaskInstance)
+    WITH ti.path AS path, ti.ID AS rank, count(*) AS count
+    CREATE (:TaskPath {path: path, rank: rank, count: count})
+    """,
+    """
+    // Query G: watermark, the events up to this timestamp are processed
+    MATCH (e:Event) WHERE e.timestamp IS NOT NULL
+    WITH e.timestamp AS timestamp ORDER BY timestamp DESC LIMIT 1
+    MERGE (w:Watermark {name: 'task_instances'})
+    SET w.timestamp = timestamp
+    """
+]
+
+# Incremental queries, only the events after the watermark are processed. Task instances
+# whose last event gains a DF_JOINT successor are rebuilt together with the new events,
+# new task instances are linked after the tail of the existing DF_TI chains and the path
+# ranks are updated from the TaskPath counts. Events are expected to arrive in time order,
+# events loaded later with a timestamp before the watermark are not picked up.
+incremental_queries = [
+    """
+    CREATE INDEX event_timestamp IF NOT EXISTS FOR (e:Event) ON (e.timestamp)
+    """,
+    """
+    CREATE INDEX task_instance_end_time IF NOT EXISTS FOR (ti:TaskInstance) ON (ti.end_time)
+    """,
+    """
+    CREATE INDEX task_instance_case_start_time IF NOT EXISTS FOR (ti:TaskInstance) ON (ti.cID, ti.start_time)
+    """,
+    """
+    CREATE INDEX task_instance_resource_start_time IF NOT EXISTS FOR (ti:TaskInstance) ON (ti.rID, ti.start_time)
+    """,
+    """
+    // Query A
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (e2:Event) WHERE e2.timestamp > w.timestamp
+    MATCH (e1:Event)-[:DF_RESOURCE]->(e2)
+    MATCH (e1)-[:DF_RUN]->(e2)
+    RETURN e1,e2",
+    "WITH e1,e2 
+    MERGE (e1)-[:DF_JOINT]->(e2)",
+    {batchSize:100})
+    """,
+    """
+    // Query B 1 part: existing task instances continued by new events are rebuilt, these
+    // are the ones ending in an event that gained a DF_JOINT successor. Task instances that
+    // only pass through such an event are still complete paths and are kept. The rebuilt
+    // chain has no case or resource and gets no DF_TI edges, so the DF_TI neighbours of a
+    // deleted task instance are linked to each other, as a full run would link them.
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (e2:Event) WHERE e2.timestamp > w.timestamp
+    MATCH (e1:Event)-[:DF_JOINT]->(e2) WHERE e1.timestamp <= w.timestamp
+    MATCH (ti:TaskInstance)-[:CONTAINS]->(e1)
+    WHERE NOT EXISTS { MATCH (ti)-[:CONTAINS]->(next:Event) WHERE (e1)-[:DF_JOINT]->(next) }
+    RETURN DISTINCT ti",
+    "OPTIONAL MATCH (tp:TaskPath) WHERE tp.path = ti.path
+    SET tp.count = tp.count - 1
+    WITH ti
+    CALL {
+    WITH ti
+    MATCH (prev:TaskInstance)-[r1:DF_TI]->(ti)-[r2:DF_TI]->(next:TaskInstance)
+    WHERE r1.EntityType = r2.EntityType
+    MERGE (prev)-[:DF_TI {EntityType: r1.EntityType}]->(next)
+    }
+    DETACH DELETE ti",
+    {batchSize:100})
+    """,
+    """
+    // Query B 2 part: every path containing a new event ends in a new event, the paths
+    // are expanded backwards from these ends to the chain starts reachable from them
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    CALL {
+    WITH w
+    MATCH (e2:Event)<-[:DF_JOINT]-() WHERE e2.timestamp > w.timestamp AND NOT (e2)-[:DF_JOINT]->()
+    WITH DISTINCT e2
+    CALL apoc.path.subgraphNodes(e2, {relationshipFilter: '<DF_JOINT'}) YIELD node
+    WITH e2, node WHERE NOT ()-[:DF_JOINT]->(node)
+    WITH e2, collect(node) AS starts
+    CALL apoc.path.expandConfig(e2, {relationshipFilter: '<DF_JOINT', minLevel: 1, terminatorNodes: starts}) YIELD path
+    WITH e2, reverse(nodes(path)) AS events
+    RETURN events, events[0] AS e1, e2, NULL as caseID, NULL as resource
+    UNION
+    WITH w
+    MATCH (ur:Run)<-[:CORR]-(e:Event)-[:CORR]->(u:Resource) WHERE e.timestamp > w.timestamp
+    AND u.sysId IS NOT NULL AND NOT ()-[:DF_JOINT]->(e) AND NOT (e)-[:DF_JOINT]->()
+    RETURN [e] AS events, e AS e1, e AS e2, ur.runId as caseID, u.sysId as resource
+    }
+    RETURN [event in events | event.activity] AS path,
+    resource AS resource, caseID AS caseID,
+    events, e1.timestamp AS start_time, e2.timestamp AS end_time",
+    "WITH path, resource, caseID, events, start_time, end_time 
+    CREATE (ti:TaskInstance {path:path, rID:resource, cID:caseID, start_time:start_time, end_time:end_time, r_count: 1, c_count: 1}) 
+    WITH ti, events 
+    UNWIND events AS e 
+    CREATE (e)<-[:CONTAINS]-(ti)",
+    {batchSize:100})
+    """,
+    """
+    // Query C
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (ti:TaskInstance) WHERE ti.end_time > w.timestamp
+    MATCH (n:Run) WHERE ti.cID = n.runId
+    RETURN ti,n",
+    "WITH ti,n
+    CREATE (ti)-[:CORR]->(n)",
+    {batchSize:100})
+    """,
+    """
+    // Query C 2 part
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (ti:TaskInstance) WHERE ti.end_time > w.timestamp
+    MATCH (n:Resource) WHERE  ti.rID = n.sysId 
+    RETURN ti,n",
+    "WITH ti,n
+    CREATE (ti)-[:CORR]->(n)",
+    {batchSize:100})
+    """,
+    """
+    // Query D: per Run only the task instances from the first new one onwards are
+    // relinked, their previous DF_TI edges are removed first
+    MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (n:Run)<-[:CORR]-(new:TaskInstance) WHERE new.end_time > w.timestamp
+    WITH n, min(new.start_time) AS cut
+    MATCH (ti:TaskInstance)-[:CORR]->(n) WHERE ti.start_time >= cut
+    MATCH ()-[df:DF_TI {EntityType:'case'}]->(ti)
+    DELETE df
+    """,
+    """
+    // Query D 2 part: the chain is continued from the tail of the existing one, the latest
+    // task instance of the Run before the cut, read from the (cID, start_time) index
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (n:Run)<-[:CORR]-(new:TaskInstance) WHERE new.end_time > w.timestamp
+    WITH n, min(new.start_time) AS cut
+    MATCH (ti:TaskInstance)-[:CORR]->(n) WHERE ti.start_time >= cut
+    WITH n, cut, ti ORDER BY ti.start_time, ID(ti)
+    WITH n, cut, COLLECT (ti) AS suffix
+    CALL {
+    WITH n, cut
+    MATCH (prev:TaskInstance) WHERE prev.cID = n.runId AND prev.start_time < cut
+    WITH prev ORDER BY prev.start_time DESC, ID(prev) DESC LIMIT 1
+    RETURN COLLECT (prev) AS tail
+    }
+    WITH n, tail + suffix AS nodeList
+    UNWIND range(0, size(nodeList)-2) AS i 
+    RETURN n, nodeList[i] as ti_first, nodeList[i+1] as ti_second",
+    "WITH n,ti_first,ti_second 
+    MERGE (ti_first)-[df:DF_TI{EntityType:'case'}]->(ti_second)",
+    {batchSize:100})
+    """,
+    """
+    // Query D 3 part: the same for Resource
+    MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (n:Resource)<-[:CORR]-(new:TaskInstance) WHERE new.end_time > w.timestamp
+    WITH n, min(new.start_time) AS cut
+    MATCH (ti:TaskInstance)-[:CORR]->(n) WHERE ti.start_time >= cut
+    MATCH ()-[df:DF_TI {EntityType:'resource'}]->(ti)
+    DELETE df
+    """,
+    """
+    // Query D 4 part: the tail is read from the (rID, start_time) index
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (n:Resource)<-[:CORR]-(new:TaskInstance) WHERE new.end_time > w.timestamp
+    WITH n, min(new.start_time) AS cut
+    MATCH (ti:TaskInstance)-[:CORR]->(n) WHERE ti.start_time >= cut
+    WITH n, cut, ti ORDER BY ti.start_time, ID(ti)
+    WITH n, cut, COLLECT (ti) AS suffix
+    CALL {
+    WITH n, cut
+    MATCH (prev:TaskInstance) WHERE prev.rID = n.sysId AND prev.start_time < cut
+    WITH prev ORDER BY prev.start_time DESC, ID(prev) DESC LIMIT 1
+    RETURN COLLECT (prev) AS tail
+    }
+    WITH n, tail + suffix AS nodeList
+    UNWIND range(0, size(nodeList)-2) AS i 
+    RETURN n, nodeList[i] as ti_first, nodeList[i+1] as ti_second",
+    "WITH n,ti_first,ti_second 
+    MERGE (ti_first)-[df:DF_TI{EntityType:'resource'}]->(ti_second)",
+    {batchSize:100})
+    """,
+    """
+    // Query E: path counts of the new task instances
+    MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (ti:TaskInstance) WHERE ti.end_time > w.timestamp
+    WITH ti.path AS path, count(*) AS count
+    MERGE (tp:TaskPath {path: path})
+    ON CREATE SET tp.count = count
+    ON MATCH SET tp.count = tp.count + count
+    """,
+    """
+    // Query E 2 part: ranks over the distinct paths, ties keep their previous order. As in a
+    // full run, a path moving up shifts the rank of every path it passes.
+    MATCH (tp:TaskPath) WHERE tp.count <= 0
+    DELETE tp
+    WITH count(*) AS deleted
+    MATCH (tp:TaskPath)
+    WITH tp ORDER BY tp.count DESC, tp.rank
+    WITH collect(tp) AS paths
+    UNWIND range(0, size(paths)-1) AS pos
+    WITH paths[pos] AS tp, pos+1 AS rank
+    WHERE tp.rank IS NULL OR tp.rank <> rank
+    SET tp.rank = rank, tp.changed = true
+    """,
+    """
+    // Query E 3 part: IDs of the new task instances and of the paths whose rank changed, the
+    // ID of existing task instances changes with the rank of their path
+    CALL apoc.periodic.iterate(
+    "MATCH (w:Watermark {name: 'task_instances'})
+    MATCH (ti:TaskInstance) WHERE ti.end_time > w.timestamp
+    MATCH (tp:TaskPath) WHERE tp.path = ti.path
+    RETURN ti, tp.rank AS rank
+    UNION
+    MATCH (tp:TaskPath {changed: true})
+    WITH collect(tp.path) AS paths, collect(tp.rank) AS ranks
+    MATCH (ti:TaskInstance) WHERE ti.path IN paths
+    RETURN ti, ranks[apoc.coll.indexOf(paths, ti.path)] AS rank",
+    "WITH ti, rank 
+    SET ti.ID = rank",
+    {batchSize:100})
+    """,
+    """
+    MATCH (tp:TaskPath {changed: true})
+    REMOVE tp.changed
+    """,
+    """
+    // Query G
+    MATCH (e:Event) WHERE e.timestamp IS NOT NULL
+    WITH e.timestamp AS timestamp ORDER BY timestamp DESC LIMIT 1
+    MERGE (w:Watermark {name: 'task_instances'})
+    SET w.timestamp = timestamp
     """
 ]
 
@@ -122,5 +373,21 @@ def execute_queries(queries):
             for query in queries:
                 session.run(query)
 
-# Execute queries
-execute_queries(queries)
+# Every incremental query starts from the watermark, without one they would all match nothing
+def has_watermark():
+    with GraphDatabase.driver(uri, auth=(username, password)) as driver:
+        with driver.session() as session:
+            record = session.run("""
+            MATCH (w:Watermark {name: 'task_instances'}) WHERE w.timestamp IS NOT NULL
+            RETURN w.timestamp AS timestamp
+            """).single()
+            return record is not None
+
+# Execute queries, with --incremental only the events after the watermark
+parser = argparse.ArgumentParser(description="Task instance construction")
+parser.add_argument("--incremental", action="store_true",
+                    help="process only the events loaded since the last run")
+args = parser.parse_args()
+if args.incremental and not has_watermark():
+    raise SystemExit("No task_instances watermark found, run a full construction without --incremental first.")
+execute_queries(incremental_queries if args.incremental else queries)
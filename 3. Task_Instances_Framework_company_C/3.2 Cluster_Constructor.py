@@ -6,6 +6,7 @@ knowledge graphs for task analysis." The link to the research paper
 (https://link.springer.com/chapter/10.1007/978-3-031-27815-0_36)" 
 """
 
+from collections import Counter
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
 import os
@@ -16,91 +17,133 @@ uri = os.getenv('NEO4J_URI')
 username = os.getenv('NEO4J_USER')
 password = os.getenv('NEO4J_PASSWORD')
 
+# Number of TaskCluster nodes or DF_TC edges written per UNWIND statement
+CLUSTER_CHUNK_SIZE = int(os.getenv('CLUSTER_CHUNK_SIZE') or 5000)
+
 # Define queries
-queries = [
-    """
-    // Query A
-    CALL apoc.periodic.iterate( 
-    "MATCH (ti:TaskInstance) WHERE ti.cluster IS NOT NULL  
-    RETURN DISTINCT ti.cluster AS cluster, count(*) AS cluster_count", 
-    "WITH cluster, cluster_count 
-    MERGE (tc:TaskCluster {Name:cluster, count:cluster_count})", 
-    {batchSize:100}) 
-    """,
-    """
-    // Query B
-    CALL apoc.periodic.iterate( 
-    "MATCH (tc:TaskCluster) 
-    MATCH (ti:TaskInstance) WHERE ti.cluster = tc.Name 
-    RETURN tc, ti", 
-    "WITH tc, ti 
-    CREATE (ti)-[:TI_OBSERVED]->(tc)", 
-    {batchSize:100}) 
-    """,
-    """
-    // Query C
-    MATCH (tc1:TaskCluster)<-[:TI_OBSERVED]-(ti1:TaskInstance)-[df:DF_TI]->(ti2:TaskInstance)-[:TI_OBSERVED]->(tc2:TaskCluster) 
-    MATCH (ti1)-[:CORR]->(user:Resource)<-[:CORR]-(ti2) 
-    WHERE user:Resource and df.EntityType = "case" 
-    WITH user, tc1, count(df) AS df_freq, tc2 
-    MERGE (tc1)-[rel2:DF_TC{EntityType:"resource"}]->(tc2) ON CREATE SET rel2.count=df_freq 
-    """,
-
-    """
-    // Query D
-    CREATE (:TaskCluster {Name:"start"})
-    """,
-    """
-    // Query E
-    CREATE (:TaskCluster {Name:"end"}) 
-    """,
-    """
-    // Query F
-    MATCH (tc:TaskCluster) WHERE NOT (:TaskCluster)-[:DF_TC {EntityType:"case"}]->(tc) 
-    AND NOT tc.Name IN ["start", "end"] 
-    WITH tc, tc.count AS count 
-    MATCH (start:TaskCluster {Name:"start"}) 
-    WITH start, tc, count 
-    MERGE (start)-[df:DF_TC {EntityType:"case", count:count}]->(tc) 
-    """,
-    """
-    // Query G
-    MATCH (tc:TaskCluster) WHERE NOT (tc)-[:DF_TC {EntityType:"case"}]->(:TaskCluster)  
-    AND NOT tc.Name IN ["start", "end"]  
-    WITH tc, tc.count AS count  
-    MATCH (end:TaskCluster {Name:"end"})  
-    WITH end, tc, count  
-    MERGE (tc)-[df:DF_TC {EntityType:"case", count:count}]->(end)
-    """,
-    """
-    // Query H
-    MATCH (ti0:TaskInstance)-[df:DF_TI {EntityType:"resource"}]->(ti1:TaskInstance) 
-    WHERE NOT date(ti0.end_time) = date(ti1.start_time) AND ti1.cluster IS NOT NULL 
-    WITH DISTINCT ti1.cluster AS cluster, count(*) AS count 
-    MATCH (tc:TaskCluster {Name:cluster}) 
-    WITH tc, count 
-    MATCH (start:TaskCluster {Name:"start"}) 
-    WITH tc, start, count 
-    MERGE (start)-[df:DF_TC {EntityType:"resource", count:count}]->(tc) 
-    """,
-    """
-    // Query I
-    MATCH (ti0:TaskInstance)-[df:DF_TI {EntityType:"resource"}]->(ti1:TaskInstance) WHERE NOT date(ti0.end_time) = date(ti1.start_time) and ti0.cluster IS NOT NULL 
-    WITH DISTINCT ti0.cluster AS cluster, count(*) AS count 
-    MATCH (tc:TaskCluster {Name:cluster}) 
-    WITH tc, count 
-    MATCH (end:TaskCluster {Name:"end"}) 
-    WITH tc, end, count 
-    MERGE (tc)-[df:DF_TC {EntityType:"resource", count:count}]->(end) 
-    """
-]
+delete_query = """
+MATCH (tc:TaskCluster)
+DETACH DELETE tc
+"""
+
+# Cluster sizes, served by the index on TaskInstance.cluster
+cluster_count_query = """
+MATCH (ti:TaskInstance) WHERE ti.cluster IS NOT NULL
+RETURN ti.cluster AS cluster, count(*) AS cluster_count
+"""
+
+# TaskCluster nodes, the start and end nodes have no count
+create_clusters_query = """
+UNWIND $rows AS row
+CREATE (:TaskCluster {Name:row.name, count:row.count})
+"""
+
+observed_query = """
+MATCH (ti:TaskInstance) WHERE ti.cluster IS NOT NULL
+MATCH (tc:TaskCluster {Name:ti.cluster})
+CREATE (ti)-[:TI_OBSERVED]->(tc)
+"""
+
+# Single pass over all DF_TI edges, the shared resource check only applies to case edges
+df_ti_query = """
+MATCH (ti0:TaskInstance)-[df:DF_TI]->(ti1:TaskInstance)
+RETURN df.EntityType AS entity_type, ti0.cluster AS cluster0, ti1.cluster AS cluster1,
+       ti0.end_time AS end_time, ti1.start_time AS start_time,
+       df.EntityType = "case" AND ti0.cluster IS NOT NULL AND ti1.cluster IS NOT NULL
+       AND EXISTS { MATCH (ti0)-[:CORR]->(:Resource)<-[:CORR]-(ti1) } AS shared_resource
+"""
+
+create_edges_query = """
+UNWIND $rows AS row
+MATCH (tc1:TaskCluster {Name:row.source})
+MATCH (tc2:TaskCluster {Name:row.target})
+CREATE (tc1)-[:DF_TC {EntityType:row.entity_type, count:row.count}]->(tc2)
+"""
+
+# Build stamp of the cluster graph, caches derived from it (dfg_cache.py) are rebuilt when it changes
+build_stamp_query = """
+MERGE (b:TaskClusterBuild {name: 'task_clusters'})
+SET b.built_at = toString(datetime())
+"""
+
+def cluster_key(cluster):
+    # Cluster names are activity paths, lists are turned into tuples to be counted
+    return tuple(cluster) if isinstance(cluster, list) else cluster
+
+def cluster_name(key):
+    return list(key) if isinstance(key, tuple) else key
+
+def day(timestamp):
+    # Calendar day of a DateTime or of an ISO formatted timestamp string
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, str):
+        return timestamp[:10]
+    return timestamp.date()
+
+def aggregate_cluster_edges(records):
+    # All cluster-level DF counts from one stream of DF_TI edges:
+    # - case edges between task instances sharing a resource give resource DF_TC edges (Query C),
+    # - resource edges across days give start and end counts of the clusters (Queries H and I)
+    resource_df = Counter()
+    starts = Counter()
+    ends = Counter()
+    for record in records:
+        cluster0 = cluster_key(record["cluster0"])
+        cluster1 = cluster_key(record["cluster1"])
+        if record["shared_resource"]:
+            resource_df[(cluster0, cluster1)] += 1
+        if record["entity_type"] == "resource":
+            end_day, start_day = day(record["end_time"]), day(record["start_time"])
+            if end_day is not None and start_day is not None and end_day != start_day:
+                if cluster1 is not None:
+                    starts[cluster1] += 1
+                if cluster0 is not None:
+                    ends[cluster0] += 1
+    return resource_df, starts, ends
+
+def write_in_chunks(tx, query, rows, chunk_size=CLUSTER_CHUNK_SIZE):
+    for start in range(0, len(rows), chunk_size):
+        tx.run(query, rows=rows[start:start + chunk_size])
+
+def build_cluster_graph(tx):
+    tx.run(delete_query)
+
+    # Query A, D and E
+    cluster_counts = {cluster_key(record["cluster"]): record["cluster_count"] for record in tx.run(cluster_count_query)}
+    cluster_rows = [{"name": cluster_name(cluster), "count": count} for cluster, count in cluster_counts.items()]
+    cluster_rows += [{"name": "start", "count": None}, {"name": "end", "count": None}]
+    write_in_chunks(tx, create_clusters_query, cluster_rows)
+    print(f"Created {len(cluster_counts)} TaskCluster nodes.")
+
+    # Query B
+    tx.run(observed_query)
+
+    resource_df, starts, ends = aggregate_cluster_edges(tx.run(df_ti_query))
+
+    edge_rows = []
+    # Query F and G, clusters are never connected by case DF_TC edges, so every cluster
+    # follows start and precedes end with its number of task instances
+    for cluster, count in cluster_counts.items():
+        edge_rows.append({"source": "start", "target": cluster_name(cluster), "entity_type": "case", "count": count})
+        edge_rows.append({"source": cluster_name(cluster), "target": "end", "entity_type": "case", "count": count})
+    # Query C, H and I
+    for (cluster0, cluster1), count in resource_df.items():
+        edge_rows.append({"source": cluster_name(cluster0), "target": cluster_name(cluster1), "entity_type": "resource", "count": count})
+    for cluster, count in starts.items():
+        edge_rows.append({"source": "start", "target": cluster_name(cluster), "entity_type": "resource", "count": count})
+    for cluster, count in ends.items():
+        edge_rows.append({"source": cluster_name(cluster), "target": "end", "entity_type": "resource", "count": count})
+    write_in_chunks(tx, create_edges_query, edge_rows)
+    print(f"Created {len(edge_rows)} DF_TC edges.")
+
+    tx.run(build_stamp_query)
 
 # Function to execute queries
-def cluster_queries(queries):
+def cluster_queries():
     with GraphDatabase.driver(uri, auth=(username, password)) as driver:
         with driver.session() as session:
-            for query in queries:
-                session.run(query)
+            session.execute_write(build_cluster_graph)
 
 # Execute queries
-cluster_queries(queries)
+cluster_queries()
@@ -8,18 +8,73 @@ knowledge graphs for task analysis." The link to the research paper
 
 
 from neo4j import GraphDatabase
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.metrics import pairwise_distances, silhouette_score
+from scipy.cluster.hierarchy import cut_tree, linkage
+from scipy.spatial.distance import squareform
+from scipy.sparse import csr_matrix
+from joblib import Parallel, delayed, effective_n_jobs
 import numpy as np
 from dotenv import load_dotenv
+import pickle
 import os
 
 load_dotenv()
 
+# Number of paths sampled per silhouette score, empty to score on all paths
+SILHOUETTE_SAMPLE_SIZE = int(os.getenv('SILHOUETTE_SAMPLE_SIZE') or 0) or None
+# Worker processes scoring candidate numbers of clusters, -1 for all cores
+CLUSTERING_WORKERS = int(os.getenv('CLUSTERING_WORKERS') or -1)
+# Candidates in a row without a better score before the sweep stops, empty to score all
+SILHOUETTE_PATIENCE = int(os.getenv('SILHOUETTE_PATIENCE') or 0) or None
+# Number of cluster labels written per UNWIND transaction
+LABEL_CHUNK_SIZE = int(os.getenv('LABEL_CHUNK_SIZE') or 5000)
+# Activity vocabulary and activity counts of every featurized task path, reused across runs
+PATH_FEATURE_CACHE = os.getenv('PATH_FEATURE_CACHE') or 'task_path_features.pkl'
+
+def score_cut(distances, clusters, sample_size=None):
+    # Silhouette score of one cut of the linkage tree, at module level so workers can run it
+    return silhouette_score(distances, clusters, metric='precomputed', sample_size=sample_size, random_state=0)
+
+class PathFeaturizer:
+    # Every activity is one token, so multi-word activity names such as "Carga L+D iniciada"
+    # stay intact. Sparse activity counts are cached on disk keyed by path, so reruns only
+    # count new paths, and the TF-IDF weights are derived from the counts of the current paths.
+    def __init__(self, cache_path=PATH_FEATURE_CACHE):
+        self.cache_path = cache_path
+        self.vocabulary = {}
+        self.counts = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                self.vocabulary, self.counts = pickle.load(f)
+
+    def _count(self, path):
+        # Token ids and their counts in one path, unseen activities extend the vocabulary
+        token_ids = [self.vocabulary.setdefault(activity, len(self.vocabulary)) for activity in path]
+        return np.unique(token_ids, return_counts=True)
+
+    def transform(self, paths):
+        keys = [tuple(path) for path in paths]
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.counts]
+        for key in new_keys:
+            self.counts[key] = self._count(key)
+        if new_keys and self.cache_path:
+            with open(self.cache_path, 'wb') as f:
+                pickle.dump((self.vocabulary, self.counts), f)
+        print(f"{len(new_keys)} new task paths featurized, {len(set(keys)) - len(new_keys)} taken from the cache.")
+
+        rows = [self.counts[key] for key in keys]
+        indptr = np.concatenate([[0], np.cumsum([len(token_ids) for token_ids, _ in rows])])
+        indices = np.concatenate([token_ids for token_ids, _ in rows]) if rows else np.array([], dtype=np.int64)
+        data = np.concatenate([counts for _, counts in rows]).astype(np.float64) if rows else np.array([])
+        X = csr_matrix((data, indices, indptr), shape=(len(keys), len(self.vocabulary)))
+        # Same weighting as TfidfVectorizer, smoothed idf over the current paths and l2 rows
+        return TfidfTransformer().fit_transform(X)
+
 class TaskAggregator:
     def __init__(self, uri, username, password):
         self.driver = GraphDatabase.driver(uri, auth=(username, password))
+        self.featurizer = PathFeaturizer()
 
     def filter_task_instances(self):
         with self.driver.session() as session:
@@ -31,31 +86,54 @@ class TaskAggregator:
             """)
             return [(record["ID"], record["path"]) for record in result]
 
-    def perform_agglomerative_clustering(self, task_instances):
-        paths = [' '.join(path) for _, path in task_instances]
-
-        vectorizer = TfidfVectorizer()
-        X = vectorizer.fit_transform(paths).toarray()
-
-        silhouette_scores = []
+    def select_num_clusters(self, distances, cuts, candidates, sample_size=SILHOUETTE_SAMPLE_SIZE,
+                            workers=CLUSTERING_WORKERS, patience=SILHOUETTE_PATIENCE):
+        # Candidates are scored concurrently, in rounds of one cut per worker when early
+        # stopping is enabled, and all at once otherwise. Returns the best number of
+        # clusters, its score and the silhouette curve of every scored candidate.
+        round_size = effective_n_jobs(workers) if patience else len(candidates)
+        curve = {}
         max_silhouette_score = -1
         best_num_clusters = 0
-
-        for num_clusters in range(2, len(task_instances)):
-            agglomerative = AgglomerativeClustering(n_clusters=num_clusters, affinity='euclidean', linkage='ward')
-            clusters = agglomerative.fit_predict(X)
-            silhouette_avg = silhouette_score(X, clusters)
-            silhouette_scores.append(silhouette_avg)
-
-            if silhouette_avg > max_silhouette_score:
-                max_silhouette_score = silhouette_avg
-                best_num_clusters = num_clusters
+        since_best = 0
+
+        with Parallel(n_jobs=workers) as parallel:
+            for start in range(0, len(candidates), round_size):
+                indices = range(start, min(start + round_size, len(candidates)))
+                scores = parallel(delayed(score_cut)(distances, cuts[:, i], sample_size) for i in indices)
+                for i, silhouette_avg in zip(indices, scores):
+                    curve[candidates[i]] = silhouette_avg
+                    if silhouette_avg > max_silhouette_score:
+                        max_silhouette_score = silhouette_avg
+                        best_num_clusters = candidates[i]
+                        since_best = 0
+                    else:
+                        since_best += 1
+                if patience and since_best >= patience:
+                    print(f"Silhouette curve peaked at {best_num_clusters} clusters, stopped after {len(curve)} candidates.")
+                    break
+
+        return best_num_clusters, max_silhouette_score, curve
+
+    def perform_agglomerative_clustering(self, task_instances, sample_size=SILHOUETTE_SAMPLE_SIZE,
+                                         workers=CLUSTERING_WORKERS, patience=SILHOUETTE_PATIENCE):
+        X = self.featurizer.transform([path for _, path in task_instances])
+
+        # The Ward linkage tree is built once from the pairwise distances of the sparse
+        # TF-IDF vectors. Every number of clusters is a cut of that same tree and is scored
+        # against the same precomputed distance matrix, optionally on a sample of paths.
+        distances = pairwise_distances(X, metric='euclidean')
+        tree = linkage(squareform(distances, checks=False), method='ward')
+        candidates = list(range(2, len(task_instances)))
+        cuts = cut_tree(tree, n_clusters=candidates)
+
+        best_num_clusters, max_silhouette_score, silhouette_scores = self.select_num_clusters(
+            distances, cuts, candidates, sample_size, workers, patience)
 
         print(f"Best number of clusters: {best_num_clusters}")
         print(f"Max Silhouette Score: {max_silhouette_score}")
 
-        agglomerative = AgglomerativeClustering(n_clusters=best_num_clusters, affinity='euclidean', linkage='ward')
-        clusters = agglomerative.fit_predict(X)
+        clusters = cuts[:, candidates.index(best_num_clusters)]
         
         unique_labels = np.unique(clusters)
         if len(unique_labels) < 2:
@@ -64,21 +142,42 @@ class TaskAggregator:
         label_map = {old_label: new_label for new_label, old_label in enumerate(unique_labels)}
         clusters_mapped = np.array([label_map[label] for label in clusters])
 
-        return clusters_mapped
+        return clusters_mapped, silhouette_scores
 
-    def assign_cluster_labels(self, task_instances, cluster_labels):
+    def create_task_instance_index(self):
+        # Labels are written back by TaskInstance ID, the index has to be online before that
+        with self.driver.session() as session:
+            session.write_transaction(self._create_task_instance_index)
+            session.run("CALL db.awaitIndexes(600)").consume()
+            print("Index on TaskInstance.ID created.")
+
+    @staticmethod
+    def _create_task_instance_index(tx):
+        tx.run("CREATE INDEX task_instance_id IF NOT EXISTS FOR (ti:TaskInstance) ON (ti.ID)")
+
+    def assign_cluster_labels(self, task_instances, cluster_labels, chunk_size=LABEL_CHUNK_SIZE):
+        # All labels are sent as UNWIND rows, one write transaction per chunk
+        rows = [{"task_id": task_id, "path": path, "cluster_label": f"Cluster_{cluster_labels[i]}"}
+                for i, (task_id, path) in enumerate(task_instances)]
         with self.driver.session() as session:
-            for i, (task_id, path) in enumerate(task_instances):
-                cluster_label = f"Cluster_{cluster_labels[i]}"
-                session.run("""
-                    MATCH (ti:TaskInstance {ID: $task_id})
-                    SET ti.cluster = $path,
-                        ti.clusterID = $cluster_label
-                """, task_id=task_id, path=path, cluster_label=cluster_label)
+            for start in range(0, len(rows), chunk_size):
+                session.write_transaction(self._set_cluster_labels, rows[start:start + chunk_size])
+            print(f"Cluster labels of {len(rows)} task paths written.")
+
+    @staticmethod
+    def _set_cluster_labels(tx, rows):
+        tx.run("""
+            UNWIND $rows AS row
+            MATCH (ti:TaskInstance {ID: row.task_id})
+            SET ti.cluster = row.path,
+                ti.clusterID = row.cluster_label
+        """, rows=rows)
 
     def main(self):
+        self.create_task_instance_index()
         task_instances = self.filter_task_instances()
-        clusters = self.perform_agglomerative_clustering(task_instances)
+        clusters, silhouette_scores = self.perform_agglomerative_clustering(task_instances)
+        print(f"Silhouette scores of {len(silhouette_scores)} candidate numbers of clusters computed.")
         self.assign_cluster_labels(task_instances, clusters)
 
     
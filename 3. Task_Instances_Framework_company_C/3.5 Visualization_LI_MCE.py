@@ -2,41 +2,24 @@
 Current code is dedicated to provide an example" 
 """
 
-from neo4j import GraphDatabase
 from graphviz import Digraph
 from dotenv import load_dotenv
+import sys
 import os
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from dfg_cache import ensure_daily_dfg, load_daily_dfg
+
 # Define Neo4j connection details
 load_dotenv()
 uri = os.getenv('NEO4J_URI')
 username = os.getenv('NEO4J_USER')
 password = os.getenv('NEO4J_PASSWORD')
 
-# Function to execute the Neo4j query
-def execute_query(query):
-    with GraphDatabase.driver(uri, auth=(username, password)) as driver:
-        with driver.session() as session:
-            result = session.run(query)
-            return result.data()
-
-# Define the Neo4j query for LI and MCE
-combined_query = """
-MATCH (tc1:TaskCluster)<-[:TI_OBSERVED]-(ti1:TaskInstance)-[:CORR]->(m:Resource) 
-WITH ti1, m, tc1
-MATCH (tc2:TaskCluster)<-[:TI_OBSERVED]-(ti2:TaskInstance)-[:CORR]->(m:Resource)
-WHERE m.sysId IN ["LI", "MCE"]
-AND date(ti1.start_time) = date('2022-01-01')  
-AND date(ti2.start_time) = date('2022-01-01') 
-WITH ti1, m, ti2, tc1, tc2
-MATCH (ti1)-[df:DF_TI {EntityType: 'resource'}]->(ti2)
-RETURN  DISTINCT ti1.cluster AS source_cluster, ti1.clusterID AS source_clusterID,
-        m.sysId AS sysId, ti2.cluster AS target_cluster, ti2.clusterID AS target_clusterID,
-        count(df) as abs_freq
-"""
-
-# Execute the Neo4j query
-result = execute_query(combined_query)
+# Read the DFG rows from the materialized daily cache (dfg_cache.py), it is only
+# built from the graph when it does not exist yet or the cluster graph was rebuilt (3.2)
+ensure_daily_dfg(uri, username, password)
+result = load_daily_dfg(resources=["LI", "MCE"], start_date='2022-01-01', end_date='2022-01-01').to_dict('records')
 
 # Create a directed graph with Graphviz
 dot = Digraph()
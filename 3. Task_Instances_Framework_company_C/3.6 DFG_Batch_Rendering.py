@@ -0,0 +1,75 @@
+"""
+Current code is dedicated to the headless rendering of the resource-level TaskCluster
+directly-follows graphs of 3.4 for many resources and days in one job. The rows of all
+requested resources and days are read at once from the daily DFG cache (dfg_cache.py),
+every (resource, day) graph is rendered by a pool of worker processes and an index of
+the rendered files is written next to them.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from graphviz import Digraph
+from dotenv import load_dotenv
+from neo4j import GraphDatabase
+import pandas as pd
+import argparse
+import re
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from dfg_cache import DFG_CACHE, ensure_daily_dfg, load_daily_dfg, refresh_daily_dfg
+
+# Define Neo4j connection details
+load_dotenv()
+uri = os.getenv('NEO4J_URI')
+username = os.getenv('NEO4J_USER')
+password = os.getenv('NEO4J_PASSWORD')
+
+def render_dfg(sys_id, day, edges, output_dir):
+    # One PNG per resource and day, at module level so worker processes can run it
+    dot = Digraph()
+    for source_cluster, target_cluster, abs_freq in edges:
+        dot.node(source_cluster, label=source_cluster)
+        dot.node(target_cluster, label=target_cluster)
+        dot.edge(source_cluster, target_cluster, label=str(abs_freq))
+    filename = re.sub(r'[^\w.-]', '_', f"dfg_{sys_id}_{day}")
+    path = dot.render(filename, directory=output_dir, format='png', cleanup=True)
+    return {"sysId": sys_id, "date": day, "file": os.path.basename(path),
+            "edges": len(edges), "abs_freq": sum(abs_freq for _, _, abs_freq in edges)}
+
+def render_dfgs(frame, output_dir, workers=None):
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(sys_id, day, list(zip(rows['source_cluster'], rows['target_cluster'], rows['abs_freq'].astype(int))))
+            for (sys_id, day), rows in frame.groupby(['sysId', 'date'], sort=True)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_dfg, sys_id, day, edges, output_dir) for sys_id, day, edges in jobs]
+        index = [future.result() for future in futures]
+
+    index = pd.DataFrame(index, columns=["sysId", "date", "file", "edges", "abs_freq"])
+    index.to_csv(os.path.join(output_dir, 'index.csv'), index=False)
+    print(f"Rendered {len(index)} graphs to {output_dir}.")
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--resources', nargs='+', help="resource sysIds to render, all by default")
+    parser.add_argument('--start-date', help="first day (YYYY-MM-DD) to render")
+    parser.add_argument('--end-date', help="last day (YYYY-MM-DD) to render")
+    parser.add_argument('--output-dir', default='dfg_graphs', help="directory of the PNG files and index.csv")
+    parser.add_argument('--workers', type=int, help="number of rendering processes, all cores by default")
+    parser.add_argument('--cache', default=DFG_CACHE, help="Parquet file of the daily DFG rows")
+    parser.add_argument('--refresh', action='store_true', help="refresh the daily DFG cache from the graph first")
+    args = parser.parse_args()
+
+    if args.refresh:
+        with GraphDatabase.driver(uri, auth=(username, password)) as driver:
+            refresh_daily_dfg(driver, args.cache)
+    else:
+        ensure_daily_dfg(uri, username, password, args.cache)
+
+    frame = load_daily_dfg(args.resources, args.start_date, args.end_date, args.cache, by_day=True)
+    render_dfgs(frame, args.output_dir, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+The code is dedicated for the materialized daily directly-follows graphs of TaskClusters per
+resource used by the visualizations (3.4, 3.5). Every row holds the number of resource DF_TI
+edges between two clusters of one resource on one day, so charts for any set of resources and
+days are read from a local Parquet file instead of re-running the cluster join on the graph.
+"""
+
+from neo4j import GraphDatabase
+from dotenv import load_dotenv
+import pandas as pd
+import argparse
+import json
+import os
+
+load_dotenv()
+
+# Local Parquet file of the daily DFG rows
+DFG_CACHE = os.getenv('DFG_CACHE') or 'daily_task_cluster_dfg.parquet'
+
+KEY_COLUMNS = ['sysId', 'date', 'source_cluster', 'source_clusterID', 'target_cluster', 'target_clusterID']
+# Column types of the cache. They are set explicitly because columns of an empty frame have no
+# type of their own, which would be written as null columns that the read filters cannot compare.
+DFG_DTYPES = dict({column: 'string' for column in KEY_COLUMNS}, abs_freq='int64')
+
+# Both task instances belong to the resource, are clustered and started on the same day.
+# With $since only the days from that date onwards are aggregated.
+DAILY_DFG_QUERY = """
+MATCH (m:Resource)<-[:CORR]-(ti1:TaskInstance)-[df:DF_TI {EntityType: 'resource'}]->(ti2:TaskInstance)-[:CORR]->(m)
+WHERE EXISTS { MATCH (ti1)-[:TI_OBSERVED]->(:TaskCluster) }
+  AND EXISTS { MATCH (ti2)-[:TI_OBSERVED]->(:TaskCluster) }
+WITH m, ti1, ti2, df, date(ti1.start_time) AS day
+WHERE day = date(ti2.start_time) AND ($since IS NULL OR day >= date($since))
+RETURN m.sysId AS sysId, toString(day) AS date,
+       ti1.cluster AS source_cluster, ti1.clusterID AS source_clusterID,
+       ti2.cluster AS target_cluster, ti2.clusterID AS target_clusterID,
+       count(df) AS abs_freq
+"""
+
+# Build stamp written by 3.2 whenever the TaskCluster graph is rebuilt, e.g. after 3.1 and 3.3
+# reran and the task instances were clustered again
+BUILD_STAMP_QUERY = """
+OPTIONAL MATCH (b:TaskClusterBuild {name: 'task_clusters'})
+RETURN b.built_at AS built_at
+"""
+
+def stamp_path(cache_path):
+    # The build stamp of the cached rows is kept next to the Parquet file
+    return cache_path + '.json'
+
+def read_cache_stamp(cache_path):
+    if not os.path.exists(stamp_path(cache_path)):
+        return None
+    with open(stamp_path(cache_path), encoding='utf-8') as f:
+        return json.load(f).get('built_at')
+
+def write_cache_stamp(cache_path, built_at):
+    with open(stamp_path(cache_path), 'w', encoding='utf-8') as f:
+        json.dump({'built_at': built_at}, f)
+
+def fetch_build_stamp(driver):
+    with driver.session() as session:
+        return session.run(BUILD_STAMP_QUERY).single()['built_at']
+
+def is_stale(driver, cache_path=DFG_CACHE):
+    # Missing cache, or rows aggregated from an earlier build of the cluster graph
+    return not os.path.exists(cache_path) or read_cache_stamp(cache_path) != fetch_build_stamp(driver)
+
+def fetch_daily_dfg(driver, since=None):
+    with driver.session() as session:
+        result = session.run(DAILY_DFG_QUERY, since=since)
+        frame = pd.DataFrame([record.values() for record in result], columns=result.keys())
+    if frame.empty:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['abs_freq']).astype(DFG_DTYPES)
+    # Clusters are activity paths, they are kept as the labels shown in the graphs
+    frame['source_cluster'] = frame['source_cluster'].map(str)
+    frame['target_cluster'] = frame['target_cluster'].map(str)
+    return frame
+
+def refresh_daily_dfg(driver, cache_path=DFG_CACHE, full=False):
+    # Only the last cached day, which may have been incomplete, and later days are
+    # aggregated again, the rows of all earlier days are kept from the cache. After the
+    # cluster graph was rebuilt the clusters of earlier days changed too, so all days are.
+    built_at = fetch_build_stamp(driver)
+    if read_cache_stamp(cache_path) != built_at:
+        full = True
+    cached = None
+    since = None
+    if not full and os.path.exists(cache_path):
+        cached = pd.read_parquet(cache_path)
+        if not cached.empty:
+            since = cached['date'].max()
+            cached = cached[cached['date'] < since]
+
+    frame = fetch_daily_dfg(driver, since)
+    if cached is not None:
+        frame = pd.concat([cached, frame], ignore_index=True)
+    frame = frame.sort_values(['date', 'sysId'], ignore_index=True)
+    frame = frame.astype(DFG_DTYPES)
+    frame.to_parquet(cache_path, index=False)
+    write_cache_stamp(cache_path, built_at)
+    print(f"Daily DFG cache refreshed from {since or 'the first day'}, {len(frame)} rows.")
+    return frame
+
+def load_daily_dfg(resources=None, start_date=None, end_date=None, cache_path=DFG_CACHE, by_day=False):
+    # DFG rows of the given resources between two ISO dates (inclusive), summed over the
+    # days unless the rows of every single day are requested
+    filters = []
+    if resources is not None:
+        filters.append(('sysId', 'in', list(resources)))
+    if start_date is not None:
+        filters.append(('date', '>=', str(start_date)))
+    if end_date is not None:
+        filters.append(('date', '<=', str(end_date)))
+    frame = pd.read_parquet(cache_path, filters=filters or None)
+    if by_day:
+        return frame
+    group_columns = [column for column in KEY_COLUMNS if column != 'date']
+    return frame.groupby(group_columns, as_index=False, sort=False, dropna=False)['abs_freq'].sum()
+
+def ensure_daily_dfg(uri, username, password, cache_path=DFG_CACHE):
+    # The cache is built on first use and rebuilt after the cluster graph changed,
+    # refreshes for newly added days are run explicitly
+    with GraphDatabase.driver(uri, auth=(username, password)) as driver:
+        if is_stale(driver, cache_path):
+            refresh_daily_dfg(driver, cache_path, full=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--full', action='store_true', help="rebuild the cache for all days")
+    parser.add_argument('--cache', default=DFG_CACHE, help="Parquet file of the daily DFG rows")
+    args = parser.parse_args()
+
+    with GraphDatabase.driver(os.getenv('NEO4J_URI'), auth=(os.getenv('NEO4J_USER'), os.getenv('NEO4J_PASSWORD'))) as driver:
+        refresh_daily_dfg(driver, args.cache, args.full)
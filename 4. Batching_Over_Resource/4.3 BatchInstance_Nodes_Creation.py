@@ -4,10 +4,32 @@ The code is dedicated for Batch nodes creation, named BatchInstances
 
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
+import argparse
 import os
 
 load_dotenv()
 
+# Number of consecutive batch numbers aggregated per write transaction
+PARTITION_SIZE = int(os.getenv('BATCH_PARTITION_SIZE') or 5000)
+
+# One BatchInstance per batch number, activity and resource, the grouping of the aggregation below.
+# Both creation paths MERGE on batch_key, so reruns update the nodes instead of duplicating them.
+BATCH_INSTANCE_MERGE = """
+            MERGE (batchInstance:BatchInstance {batch_key: toString(batch_number) + '|' + coalesce(activity, '') + '|' + coalesce(resource_sys_id, '')})
+            SET batchInstance += {
+                batch_number: batch_number,
+                activity: activity,
+                kits: kits,
+                kits_number: kit_count,
+                event_number: event_count,
+                resource_sys_id: resource_sys_id,
+                runs: CASE WHEN size(runs) > 0 THEN runs ELSE [] END,
+                earliest_timestamp: earliest_timestamp,
+                latest_timestamp: latest_timestamp
+            }
+            RETURN COUNT(batchInstance) AS created_instances
+"""
+
 class BatchInstanceCreator:
     def __init__(self, uri, username, password):
         self.driver = GraphDatabase.driver(uri, auth=(username, password))
@@ -15,6 +37,68 @@ class BatchInstanceCreator:
     def close(self):
         self.driver.close()
 
+    def create_schema(self):
+        # Indexes and constraints are created up front, so every partition below
+        # starts from an index range seek on e.batch and MERGEs on a unique key
+        with self.driver.session() as session:
+            session.write_transaction(self._create_event_index)
+            session.write_transaction(self._create_batch_instance_constraint)
+            session.write_transaction(self._create_batch_number_index)
+            print("Indexes and constraints creation queries executed.")
+
+    @staticmethod
+    def _create_event_index(tx):
+        tx.run("CREATE INDEX batch_for_events IF NOT EXISTS FOR (e:Event) ON (e.batch)")
+
+    @staticmethod
+    def _create_batch_instance_constraint(tx):
+        tx.run("""
+        CREATE CONSTRAINT batch_instance_key IF NOT EXISTS
+        FOR (b:BatchInstance) REQUIRE b.batch_key IS UNIQUE
+        """)
+
+    @staticmethod
+    def _create_batch_number_index(tx):
+        tx.run("CREATE INDEX batch_instance_batch_number IF NOT EXISTS FOR (b:BatchInstance) ON (b.batch_number)")
+
+    def create_batch_instances_partitioned(self, partition_size=PARTITION_SIZE, resume=False):
+        # Batch numbers are processed in ranges of partition_size, one transaction each.
+        # Partitions MERGE on batch_key, so a failed run can be resumed from the
+        # partition of the highest existing BatchInstance without creating duplicates.
+        with self.driver.session() as session:
+            max_batch = session.run("""
+            MATCH (e:Event) WHERE e.batch IS NOT NULL
+            RETURN max(e.batch) AS max_batch
+            """).single()["max_batch"]
+            if max_batch is None:
+                print("No events with batch numbers found.")
+                return
+
+            start = 1
+            if resume:
+                done = session.run("MATCH (b:BatchInstance) RETURN max(b.batch_number) AS done").single()["done"]
+                if done is not None:
+                    start = done - (done - 1) % partition_size
+
+            total = 0
+            for lower in range(start, max_batch + 1, partition_size):
+                upper = lower + partition_size
+                total += session.write_transaction(self._create_batch_instance_partition, lower, upper)
+                print(f"Batches {lower}-{upper - 1} processed, {total} BatchInstance nodes created or updated.")
+            print(f"{total} BatchInstance nodes created or updated.")
+
+    @staticmethod
+    def _create_batch_instance_partition(tx, lower, upper):
+        result = tx.run("""
+            MATCH (e:Event) WHERE e.batch >= $lower AND e.batch < $upper
+            MATCH (u:Resource)<-[:CORR]-(e)-[:CORR]->(k:Kit)
+            WITH e.batch AS batch_number, e.activity AS activity, u.sysId AS resource_sys_id,
+                 COLLECT(DISTINCT k.kitId) AS kits, COLLECT(DISTINCT k.runId) AS runs,
+                 MIN(e.timestamp) AS earliest_timestamp, MAX(e.timestamp) AS latest_timestamp,
+                 COUNT(DISTINCT k.kitId) AS kit_count, COUNT(e) AS event_count
+            """ + BATCH_INSTANCE_MERGE, lower=lower, upper=upper)
+        return result.single()["created_instances"]
+
     def create_batch_instances(self):
         with self.driver.session() as session:
             result = session.run("""
@@ -24,32 +108,33 @@ class BatchInstanceCreator:
                  MIN(e.timestamp) AS earliest_timestamp, MAX(e.timestamp) AS latest_timestamp,
                  COUNT(DISTINCT k.kitId) AS kit_count, COUNT(e) AS event_count
             WHERE batch_number IS NOT NULL 
-            CREATE (batchInstance:BatchInstance {
-                batch_number: batch_number,
-                activity: activity,
-                kits: kits,
-                kits_number: kit_count,
-                event_number: event_count,
-                resource_sys_id: resource_sys_id,
-                runs: CASE WHEN size(runs) > 0 THEN runs ELSE [] END,
-                earliest_timestamp: earliest_timestamp,
-                latest_timestamp: latest_timestamp
-            })
-            RETURN COUNT(batchInstance) AS created_instances
-            """)
+            """ + BATCH_INSTANCE_MERGE)
 
             created_instances = result.single()
             created_instances_count = created_instances["created_instances"] if created_instances else 0
-            print(f"{created_instances_count} BatchInstance nodes created.")
+            print(f"{created_instances_count} BatchInstance nodes created or updated.")
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--partition-size', type=int, default=PARTITION_SIZE,
+                        help="number of batch numbers aggregated per transaction")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue from the partition of the highest existing BatchInstance")
+    parser.add_argument('--single-transaction', action='store_true',
+                        help="create or update all BatchInstance nodes in one statement")
+    args = parser.parse_args()
+
     uri = os.getenv('NEO4J_URI')
     username = os.getenv('NEO4J_USER')
     password = os.getenv('NEO4J_PASSWORD')
     creator = BatchInstanceCreator(uri, username, password)
 
     try:
-        creator.create_batch_instances()
+        creator.create_schema()
+        if args.single_transaction:
+            creator.create_batch_instances()
+        else:
+            creator.create_batch_instances_partitioned(args.partition_size, args.resume)
     finally:
         creator.close()
 
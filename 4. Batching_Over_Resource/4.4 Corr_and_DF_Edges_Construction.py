@@ -4,10 +4,16 @@ The code is dedicated for constracting directly-follow and correlated relations
 
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
+import argparse
 import os
 
 load_dotenv()
 
+# apoc.periodic.iterate batch size of the CORR construction on freshly built BatchInstance nodes
+CORR_BATCH_SIZE = int(os.getenv('CORR_BATCH_SIZE') or 10000)
+# Number of days whose DF_BATCH_KIT edges are built concurrently
+DF_KIT_CONCURRENCY = int(os.getenv('DF_KIT_CONCURRENCY') or 4)
+
 class BatchInstanceRelationshipCreator:
     def __init__(self, uri, username, password):
         self.driver = GraphDatabase.driver(uri, auth=(username, password))
@@ -29,23 +35,77 @@ class BatchInstanceRelationshipCreator:
     def _create_kit_index(tx):
         tx.run("CREATE INDEX batch_for_kits IF NOT EXISTS FOR (e:Kit) ON (e.kitId)")
 
-    def create_relationships(self):
+    def create_relationships(self, corr=True, fresh=False, batch_size=CORR_BATCH_SIZE):
+        # corr=False skips the CORR edges, e.g. when they were already created
+        # by the fused batch assignment stage (4.2/5.2 --fused)
         with self.driver.session() as session:
-            # Connect BatchInstance to Resource based on resource sysId
-            session.write_transaction(self._connect_batch_instance_to_resource)
-            print("Query to connect BatchInstance to Resource executed.")
-            # Connect BatchInstance to Event based on batch_number
-            session.write_transaction(self._connect_batch_instance_to_event)
-            print("Query to connect BatchInstance to Event executed.")
-            # Connect BatchInstance to Kit based on kits
-            session.write_transaction(self._connect_batch_instance_to_kit)
-            print("Query to connect BatchInstance to Kit executed.")
-            # Create DF edges between BatchInstances related to Kits
-            session.write_transaction(self._connect_batch_instances_kit)
-            print("Query to connect BatchInstance executed.")
-            # Create DF edges between BatchInstances related to Resource
-            session.write_transaction(self._connect_batch_instances_resource)
-            print("Query to connect BatchInstance executed.")
+            if corr and fresh:
+                self._create_fresh_corr_relationships(session, batch_size)
+            elif corr:
+                self._create_corr_relationships(session)
+            self._create_df_relationships(session)
+
+    def _create_fresh_corr_relationships(self, session, batch_size):
+        # BatchInstance nodes were just created and have no CORR edges yet, so edges are
+        # CREATEd instead of MERGEd. Events are found through the e.batch index.
+        session.write_transaction(self._create_batch_instance_event_corr, batch_size)
+        print("Query to connect BatchInstance to Event executed.")
+        session.write_transaction(self._create_batch_instance_resource_corr, batch_size)
+        print("Query to connect BatchInstance to Resource executed.")
+        session.write_transaction(self._create_batch_instance_kit_corr, batch_size)
+        print("Query to connect BatchInstance to Kit executed.")
+
+    @staticmethod
+    def _create_batch_instance_event_corr(tx, batch_size):
+        # A batch number can have several BatchInstances (one per activity and resource) sharing
+        # its events, so parallel batches could lock the same event and this step runs serially
+        tx.run("""
+            CALL apoc.periodic.iterate(
+            "MATCH (n:BatchInstance) RETURN n",
+            "MATCH (e:Event {batch: n.batch_number}) CREATE (e)-[:CORR]->(n)",
+            {batchSize: $batch_size, parallel: false})
+        """, batch_size=batch_size)
+
+    @staticmethod
+    def _create_batch_instance_resource_corr(tx, batch_size):
+        # Resources are shared by many batches, parallel batches would contend on their locks
+        tx.run("""
+            CALL apoc.periodic.iterate(
+            "MATCH (n:BatchInstance) RETURN n",
+            "MATCH (u:Resource {sysId: n.resource_sys_id}) CREATE (u)-[:CORR]->(n)",
+            {batchSize: $batch_size, parallel: false})
+        """, batch_size=batch_size)
+
+    @staticmethod
+    def _create_batch_instance_kit_corr(tx, batch_size):
+        # (kit, batch) pairs are deduplicated before the CREATE instead of one MERGE per event.
+        # Kits recur in many batches, so this step is not run in parallel either.
+        tx.run("""
+            CALL apoc.periodic.iterate(
+            "MATCH (n:BatchInstance) RETURN n",
+            "MATCH (e:Event {batch: n.batch_number})-[:CORR]->(k:Kit) WITH DISTINCT k, n CREATE (k)-[:CORR]->(n)",
+            {batchSize: $batch_size, parallel: false})
+        """, batch_size=batch_size)
+
+    def _create_corr_relationships(self, session):
+        # Connect BatchInstance to Resource based on resource sysId
+        session.write_transaction(self._connect_batch_instance_to_resource)
+        print("Query to connect BatchInstance to Resource executed.")
+        # Connect BatchInstance to Event based on batch_number
+        session.write_transaction(self._connect_batch_instance_to_event)
+        print("Query to connect BatchInstance to Event executed.")
+        # Connect BatchInstance to Kit based on kits
+        session.write_transaction(self._connect_batch_instance_to_kit)
+        print("Query to connect BatchInstance to Kit executed.")
+
+    def _create_df_relationships(self, session):
+        # Create DF edges between BatchInstances related to Kits
+        session.write_transaction(self._delete_batch_instances_kit)
+        session.write_transaction(self._connect_batch_instances_kit, DF_KIT_CONCURRENCY)
+        print("Query to connect BatchInstance executed.")
+        # Create DF edges between BatchInstances related to Resource
+        session.write_transaction(self._connect_batch_instances_resource)
+        print("Query to connect BatchInstance executed.")
 
     @staticmethod
     def _connect_batch_instance_to_resource(tx):
@@ -77,21 +137,45 @@ class BatchInstanceRelationshipCreator:
         """)
 
     @staticmethod
-    def _connect_batch_instances_kit(tx):
+    def _delete_batch_instances_kit(tx):
         tx.run("""
-        MATCH (k:Kit)<-[:CORR]-(e:Event)-[:DF_KIT]->(e1:Event)-[:CORR]->(k)
-        MATCH (e)-[:CORR]->(n:BatchInstance), (e1)-[:CORR]->(n1:BatchInstance)
-        WHERE n.batch_number = e.batch AND n1.batch_number = e1.batch AND e.batch <> e1.batch
-        WITH n, n1, k.kitId AS kitId, k.runId AS runId
-        CALL apoc.do.when(
-            runId IS NOT NULL,
-            "MERGE (n)-[r:DF_BATCH_KIT {kitId: $kitId, runId: $runId}]->(n1) RETURN r",
-            "MERGE (n)-[r:DF_BATCH_KIT {kitId: $kitId}]->(n1) RETURN r",
-            {n:n, n1:n1, kitId:kitId, runId:runId}
-        )YIELD value
-        RETURN count(value) AS newRelationshipsCreated
+            CALL apoc.periodic.iterate(
+            "MATCH (:BatchInstance)-[r:DF_BATCH_KIT]->(:BatchInstance) RETURN r",
+            "DELETE r",
+            {batchSize:10000})
         """)
 
+    @staticmethod
+    def _connect_batch_instances_kit(tx, concurrency):
+        # One partition per day of the source BatchInstance, run concurrently. The node ids of
+        # every day are collected in a single scan, so a partition looks up its own nodes by id
+        # instead of scanning all BatchInstances again. Rows are deduplicated per
+        # (n, n1, kitId, runId) and the edge is CREATEd once with runId set afterwards, which
+        # leaves the property out for kits without a run, as before.
+        # Each edge is created only by the partition of its source. Days share target nodes, so a
+        # day can still fail on deadlocks after its retries. The old edges are already deleted by
+        # then, so failed days raise instead of leaving the DF_BATCH_KIT edges silently incomplete.
+        result = tx.run("""
+            CALL apoc.periodic.iterate(
+            "MATCH (n:BatchInstance)
+            RETURN date(n.earliest_timestamp) AS day, collect(id(n)) AS ids",
+            "UNWIND ids AS id
+            MATCH (n:BatchInstance) WHERE id(n) = id
+            MATCH (e:Event)-[:CORR]->(n) WHERE n.batch_number = e.batch
+            MATCH (k:Kit)<-[:CORR]-(e)-[:DF_KIT]->(e1:Event)-[:CORR]->(k)
+            MATCH (e1)-[:CORR]->(n1:BatchInstance)
+            WHERE n1.batch_number = e1.batch AND e.batch <> e1.batch
+            WITH DISTINCT n, n1, k.kitId AS kitId, k.runId AS runId
+            CREATE (n)-[r:DF_BATCH_KIT {kitId: kitId}]->(n1)
+            SET r.runId = runId",
+            {batchSize:1, parallel:true, concurrency:$concurrency, retries:3})
+            YIELD batches, failedBatches, errorMessages
+            RETURN batches, failedBatches, errorMessages
+        """, concurrency=concurrency).single()
+        if result["failedBatches"] > 0:
+            raise RuntimeError(f"DF_BATCH_KIT construction failed for {result['failedBatches']} of "
+                               f"{result['batches']} days: {result['errorMessages']}")
+
     @staticmethod
     def _connect_batch_instances_resource(tx):
         tx.run("""
@@ -105,6 +189,15 @@ class BatchInstanceRelationshipCreator:
             """)
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--skip-corr', action='store_true',
+                        help="only create DF edges, CORR edges already exist (fused batch assignment)")
+    parser.add_argument('--fresh', action='store_true',
+                        help="BatchInstance nodes were just created, CREATE their CORR edges instead of MERGE")
+    parser.add_argument('--batch-size', type=int, default=CORR_BATCH_SIZE,
+                        help="apoc.periodic.iterate batch size of the fresh CORR construction")
+    args = parser.parse_args()
+
     uri = os.getenv('NEO4J_URI')
     username = os.getenv('NEO4J_USER')
     password = os.getenv('NEO4J_PASSWORD')
@@ -112,7 +205,7 @@ def main():
 
     try:
         creator.create_indexes()
-        creator.create_relationships()
+        creator.create_relationships(corr=not args.skip_corr, fresh=args.fresh, batch_size=args.batch_size)
     finally:
         creator.close()
 
@@ -2,13 +2,77 @@
 The code is dedicated for defining the logic of batch over activity assigning batch values to Event nodes
 """
 
-from datetime import datetime, timedelta
+from datetime import timedelta
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
+import argparse
 import os
+import pandas as pd
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch_segmentation import segment_batches, segment_frame, sweep_gap_thresholds
+from batch_instances import (BATCH_INSTANCE_CHUNK_SIZE, FUSED_EVENT_FIELDS, FUSED_EVENTS_QUERY,
+                             ActivityBatchInstanceAggregate, aggregate_batch_instances, chunked,
+                             create_batch_instances, delete_batch_instances, write_in_chunks)
 
 load_dotenv()
 
+# Number of (id, batch) rows shipped to the database per UNWIND write
+CHUNK_SIZE = int(os.getenv('BATCH_WRITE_CHUNK_SIZE') or 10000)
+# Number of sessions writing chunks concurrently (1 = a single session)
+WRITE_WORKERS = int(os.getenv('BATCH_WRITE_WORKERS') or 1)
+# Consecutive events further apart than BATCH_GAP start a new batch
+BATCH_GAP = timedelta(minutes=5)
+BATCH_GAP_MILLIS = int(BATCH_GAP.total_seconds() * 1000)
+# Consecutive events stay in one batch only if they share these properties (same activity)
+BATCH_KEYS = ('activity',)
+# Layout of the event tuples produced by EventBatchAssigner.stream_events
+EVENT_FIELDS = ('id', 'activity', 'timestamp', 'resourceSysId')
+# Local columnar cache of the event columns used by the gap-threshold sweep
+EVENT_CACHE = os.getenv('EVENT_CACHE_ACTIVITY') or 'event_columns_batching_over_activity.pkl'
+
+EVENTS_QUERY = """
+MATCH (u:Resource)<-[:CORR]-(e:Event)-[:CORR]->(k:Kit)
+RETURN id(e) AS id, e.activity AS activity, datetime(e.timestamp).epochMillis AS timestamp, u.sysId AS resourceSysId, k.kitId AS kitId
+ORDER BY e.activity,  e.timestamp ASC
+"""
+
+# Number of events and latest event timestamp in the graph, compared with the cached event
+# columns before their batches are written back by node id
+EVENTS_STATE_QUERY = """
+MATCH (u:Resource)<-[:CORR]-(e:Event)-[:CORR]->(k:Kit)
+RETURN count(*) AS events, max(datetime(e.timestamp).epochMillis) AS timestamp, max(id(e)) AS maxId
+"""
+
+# The fused stage reads the events in the processing order of the segmentation above
+EVENTS_FUSED_QUERY = FUSED_EVENTS_QUERY.format(order_by="e.activity, e.timestamp ASC")
+
+
+def segment_events(events, gap_millis=BATCH_GAP_MILLIS, chunk_size=CHUNK_SIZE):
+    # Streaming form of the batching rule: consumes tuples laid out as EVENT_FIELDS (possibly
+    # followed by more fields) and yields (event, batch) pairs, segmenting chunk by chunk with
+    # the shared engine. The last event of the previous chunk is carried over so that batches
+    # continue across chunk borders.
+    key_positions = [EVENT_FIELDS.index(key) for key in BATCH_KEYS]
+    timestamp_position = EVENT_FIELDS.index('timestamp')
+    carried, last_batch = [], 0
+    for chunk in chunked(events, chunk_size):
+        window = carried + chunk
+        columns = list(zip(*window))
+        batches = segment_batches(columns[timestamp_position],
+                                  [columns[i] for i in key_positions],
+                                  gap_millis) + (last_batch - len(carried))
+        for event, batch in zip(window[len(carried):], batches[len(carried):]):
+            yield event, int(batch)
+        carried, last_batch = [window[-1]], int(batches[-1])
+
+
+def assign_batches(events, gap_millis=BATCH_GAP_MILLIS, chunk_size=CHUNK_SIZE):
+    for event, batch in segment_events(events, gap_millis, chunk_size):
+        yield {'id': event[0], 'batch': batch}
+
+
 class EventBatchAssigner:
     def __init__(self, uri, username, password):
         self.driver = GraphDatabase.driver(uri, auth=(username, password))
@@ -18,40 +82,91 @@ class EventBatchAssigner:
 
     def fetch_events(self):
         with self.driver.session() as session:
-            result = session.run("""
-            MATCH (u:Resource)<-[:CORR]-(e:Event)-[:CORR]->(k:Kit)
-            RETURN id(e) AS id, e.activity AS activity, datetime(e.timestamp).epochMillis AS timestamp, u.sysId AS resourceSysId
-            ORDER BY e.activity,  e.timestamp ASC
-            """)
+            result = session.run(EVENTS_QUERY)
             return [{**record} for record in result]
 
-    def process_and_update_events(self, events):
+    def stream_events(self, query=EVENTS_QUERY, fields=EVENT_FIELDS):
+        # Generator counterpart of fetch_events: records are consumed from the open
+        # cursor one at a time, so client memory does not grow with the log size
+        with self.driver.session() as session:
+            result = session.run(query)
+            for record in result:
+                yield tuple(record[field] for field in fields)
+
+    def process_and_update_events_streaming(self, chunk_size=CHUNK_SIZE, workers=WRITE_WORKERS,
+                                            gap_millis=BATCH_GAP_MILLIS):
+        # Batches are assigned while the read cursor is consumed and written back in
+        # chunks as soon as they fill up, so writes start before the read finishes
+        rows = assign_batches(self.stream_events(), gap_millis, chunk_size)
+        return self.update_event_batches(rows, chunk_size=chunk_size, workers=workers)
+
+    def process_events_fused(self, chunk_size=BATCH_INSTANCE_CHUNK_SIZE, workers=WRITE_WORKERS,
+                             gap_millis=BATCH_GAP_MILLIS):
+        # Fused form of batch assignment, BatchInstance creation and the CORR edges of the
+        # next two stages: one read of the events, one bulk write of e.batch, BatchInstance
+        # nodes and their CORR edges to Events, Kits and Resources
+        with self.driver.session() as session:
+            session.write_transaction(delete_batch_instances)
+        segmented = segment_events(self.stream_events(EVENTS_FUSED_QUERY, FUSED_EVENT_FIELDS), gap_millis)
+        rows = aggregate_batch_instances(segmented, ActivityBatchInstanceAggregate)
+        written = self.write_in_chunks(rows, create_batch_instances, chunk_size, workers, 'BatchInstance nodes')
+        print(f"Created {written} BatchInstance nodes with their CORR edges.")
+        return written
+
+    def fetch_event_columns(self, cache_path=EVENT_CACHE, refresh=False):
+        # Events are pulled from the graph once and kept as a categorical DataFrame on
+        # disk, later sweeps and the final write-back only read the local cache
+        if not refresh and os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+        with self.driver.session() as session:
+            result = session.run(EVENTS_QUERY)
+            frame = pd.DataFrame([record.values() for record in result], columns=result.keys())
+        for column in ('activity', 'resourceSysId', 'kitId'):
+            frame[column] = frame[column].astype('category')
+        frame['timestamp'] = frame['timestamp'].astype('int64')
+        frame.to_pickle(cache_path)
+        return frame
+
+    def check_event_columns(self, frame):
+        # The cache is keyed by id(e), a cache taken before events were added, removed or the
+        # graph was re-imported would write batches to the wrong nodes
+        with self.driver.session() as session:
+            state = session.run(EVENTS_STATE_QUERY).single()
+        cached = {'events': len(frame),
+                  'timestamp': int(frame['timestamp'].max()) if len(frame) else None,
+                  'maxId': int(frame['id'].max()) if len(frame) else None}
+        if any(cached[key] != state[key] for key in cached):
+            raise RuntimeError(f"Cached event columns {cached} do not match the graph "
+                               f"{dict(state)}, rerun with --refresh-cache.")
+
+    def sweep_gap_thresholds(self, gap_minutes, frame=None):
+        # Batch counts, size distributions and kits per batch for every candidate threshold
+        if frame is None:
+            frame = self.fetch_event_columns()
+        return sweep_gap_thresholds(frame, BATCH_KEYS, [int(minutes * 60000) for minutes in gap_minutes])
+
+    def update_from_event_columns(self, frame, gap_millis=BATCH_GAP_MILLIS, chunk_size=CHUNK_SIZE,
+                                  workers=WRITE_WORKERS):
+        # Writes the batches of the chosen threshold back to the graph without re-fetching events
+        self.check_event_columns(frame)
+        batches = segment_frame(frame, BATCH_KEYS, gap_millis)
+        rows = ({'id': int(event_id), 'batch': int(batch)} for event_id, batch in zip(frame['id'], batches))
+        return self.update_event_batches(rows, chunk_size=chunk_size, workers=workers)
+
+    def process_and_update_events(self, events, chunk_size=CHUNK_SIZE, workers=WRITE_WORKERS,
+                                  gap_millis=BATCH_GAP_MILLIS):
         if not events:
             return
 
-        current_batch = 1
-        # Mark the first event with the initial batch number
-        events[0]['batch'] = current_batch
-        prev_event = events[0]
-
-        # Start from the second event
-        for event in events[1:]:
-            event_time = datetime.fromtimestamp(event['timestamp'] / 1000.0)
-            prev_event_time = datetime.fromtimestamp(prev_event['timestamp'] / 1000.0)
-
-            if (event['activity'] == prev_event['activity'] and
-                (event_time - prev_event_time) < timedelta(minutes=5)):
-                event['batch'] = current_batch
-            else:
-                current_batch += 1
-                event['batch'] = current_batch
-            
-            prev_event = event
+        batches = segment_batches([event['timestamp'] for event in events],
+                                  [[event[key] for event in events] for key in BATCH_KEYS],
+                                  gap_millis)
+        for event, batch in zip(events, batches):
+            event['batch'] = int(batch)
 
         # Update all events in the database after batch assignment
-        for event in events:
-            self.update_event_batch(event['id'], event['batch'])
-            print(f"Updated event {event['id']} with batch {event['batch']}")
+        rows = ({'id': event['id'], 'batch': event['batch']} for event in events)
+        self.update_event_batches(rows, chunk_size=chunk_size, workers=workers)
 
     def update_event_batch(self, event_id, batch_number):
         with self.driver.session() as session:
@@ -60,17 +175,63 @@ class EventBatchAssigner:
             SET e.batch = $batch_number
             """, event_id=event_id, batch_number=batch_number))
 
+    def update_event_batches(self, rows, chunk_size=CHUNK_SIZE, workers=WRITE_WORKERS):
+        # Bulk counterpart of update_event_batch for rows of {'id', 'batch'}
+        written = self.write_in_chunks(rows, self._set_event_batches, chunk_size, workers, 'events')
+        print(f"Updated {written} events with batch numbers.")
+        return written
+
+    def write_in_chunks(self, rows, work, chunk_size=CHUNK_SIZE, workers=WRITE_WORKERS, label='rows'):
+        return write_in_chunks(self.driver, rows, work, chunk_size, workers, label)
+
+    @staticmethod
+    def _set_event_batches(tx, rows):
+        tx.run("""
+        UNWIND $rows AS row
+        MATCH (e:Event) WHERE id(e) = row.id
+        SET e.batch = row.batch
+        """, rows=rows)
+
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gap-minutes', type=float,
+                        help="gap threshold written to e.batch (default: 5)")
+    parser.add_argument('--sweep', type=float, nargs='+', metavar='MINUTES',
+                        help="evaluate these gap thresholds on the cached event columns; "
+                             "e.batch is only written when --gap-minutes is given as well")
+    parser.add_argument('--refresh-cache', action='store_true', help="re-fetch the cached event columns")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="fetch all events before assignment instead of streaming them")
+    parser.add_argument('--fused', action='store_true',
+                        help="also create BatchInstance nodes and their CORR edges in the same pass")
+    args = parser.parse_args()
+    gap_millis = BATCH_GAP_MILLIS if args.gap_minutes is None else int(args.gap_minutes * 60000)
+
     uri = os.getenv('NEO4J_URI')
     username = os.getenv('NEO4J_USER')
     password = os.getenv('NEO4J_PASSWORD')
     assigner = EventBatchAssigner(uri, username, password)
 
     try:
-        print("Fetching events...")
-        events = assigner.fetch_events()
-        print(f"Fetched {len(events)} events. Processing and updating...")
-        assigner.process_and_update_events(events)
+        if args.sweep:
+            print("Loading event columns...")
+            frame = assigner.fetch_event_columns(refresh=args.refresh_cache)
+            print(f"Loaded {len(frame)} events. Sweeping gap thresholds...")
+            print(assigner.sweep_gap_thresholds(args.sweep, frame).to_string(index=False))
+            if args.gap_minutes is not None:
+                print(f"Writing batches for a gap of {args.gap_minutes} minutes...")
+                assigner.update_from_event_columns(frame, gap_millis)
+        elif args.fused:
+            print("Streaming events, creating BatchInstance nodes and CORR edges...")
+            assigner.process_events_fused(gap_millis=gap_millis)
+        elif args.in_memory:
+            print("Fetching events...")
+            events = assigner.fetch_events()
+            print(f"Fetched {len(events)} events. Processing and updating...")
+            assigner.process_and_update_events(events, gap_millis=gap_millis)
+        else:
+            print("Streaming events and updating batches...")
+            assigner.process_and_update_events_streaming(gap_millis=gap_millis)
     finally:
         assigner.close()
 
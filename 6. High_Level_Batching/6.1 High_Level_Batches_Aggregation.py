@@ -3,9 +3,16 @@ It consists of high-level batch creation and construction
 of directly-follow and correlated relations
 """
 
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
+import argparse
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch_instances import chunked
 
 # Connect to the Neo4j database
 load_dotenv()
@@ -14,370 +21,254 @@ username = os.getenv('NEO4J_USER')
 password = os.getenv('NEO4J_PASSWORD')
 driver = GraphDatabase.driver(uri, auth=(username, password))
 
-def delete_high_level_batches(tx):
-    # Delete existing HighLevelBatch nodes and their edges
-    query = """
+# Number of HighLevelBatch nodes created per UNWIND write
+HLB_CHUNK_SIZE = int(os.getenv('HLB_CHUNK_SIZE') or 10000)
+# Number of duplicate HighLevelBatch nodes deleted per UNWIND write
+DUPLICATE_CHUNK_SIZE = int(os.getenv('HLB_DUPLICATE_CHUNK_SIZE') or 10000)
+
+# Uniqueness key of a HighLevelBatch: sysId, date and its sorted batch numbers
+HLB_KEY = "{hlb}.sysId + '|' + toString({hlb}.date) + '|' + apoc.text.join([n IN apoc.coll.sort({hlb}.corr_batch_numbers) | toString(n)], ',')"
+
+def in_date_range(value, start_date=None, end_date=None):
+    # Restricts a date property to the $start_date..$end_date range of an incremental run. Only
+    # the given bounds are written into the query, so it can seek a range index on the property,
+    # and a run without dates is not restricted at all
+    bounds = []
+    if start_date is not None:
+        bounds.append(f"{value} >= $start_date")
+    if end_date is not None:
+        bounds.append(f"{value} <= $end_date")
+    return "(" + " AND ".join(bounds) + ")" if bounds else "true"
+
+def in_timestamp_range(value, start_date=None, end_date=None):
+    # Same restriction on a timestamp property, from the first instant of $start_date up to
+    # the first instant after $end_date, see timestamp_bounds
+    bounds = []
+    if start_date is not None:
+        bounds.append(f"{value} >= $start_timestamp")
+    if end_date is not None:
+        bounds.append(f"{value} < $end_timestamp")
+    return "(" + " AND ".join(bounds) + ")" if bounds else "true"
+
+def timestamp_bounds(tx, start_date=None, end_date=None):
+    # BatchInstance.earliest_timestamp keeps the type of the event timestamps, and values of
+    # different temporal types do not compare, so the bounds are built like a stored value
+    if start_date is None and end_date is None:
+        return {"start_timestamp": None, "end_timestamp": None}
+    record = tx.run("""
+    MATCH (batch:BatchInstance) WHERE batch.earliest_timestamp IS NOT NULL
+    RETURN batch.earliest_timestamp AS timestamp LIMIT 1
+    """).single()
+    sample = record["timestamp"] if record else None
+
+    def bound(day):
+        if day is None:
+            return None
+        if isinstance(sample, str):
+            return day.isoformat()
+        return datetime.combine(day, time(), tzinfo=getattr(sample, "tzinfo", None))
+
+    return {"start_timestamp": bound(start_date),
+            "end_timestamp": bound(end_date + timedelta(days=1) if end_date is not None else None)}
+
+def create_high_level_batch_indexes(tx):
+    # Nodes created by the in-memory engine carry a unique batch_key so duplicates cannot arise
+    tx.run("CREATE CONSTRAINT high_level_batch_key IF NOT EXISTS FOR (hlb:HighLevelBatch) REQUIRE hlb.batch_key IS UNIQUE")
+    # Incremental runs select the BatchInstance and HighLevelBatch nodes of their dates
+    tx.run("CREATE INDEX batch_instance_earliest_timestamp IF NOT EXISTS FOR (batch:BatchInstance) ON (batch.earliest_timestamp)")
+    tx.run("CREATE INDEX high_level_batch_date IF NOT EXISTS FOR (hlb:HighLevelBatch) ON (hlb.date)")
+    print("Indexes on BatchInstance.earliest_timestamp and HighLevelBatch.date and uniqueness constraint on HighLevelBatch.batch_key created.")
+
+def delete_high_level_batches(tx, start_date=None, end_date=None):
+    # Delete existing HighLevelBatch nodes and their edges, only within the date range if one is given
+    query = f"""
     MATCH (hlb:HighLevelBatch)
+    WHERE {in_date_range("hlb.date", start_date, end_date)}
     DETACH DELETE hlb
     """
-    tx.run(query)
+    tx.run(query, start_date=start_date, end_date=end_date)
     print("Deleted existing HighLevelBatch nodes and edges.")
 
-def create_high_level_batches_v2(tx):
-    # Step 1: Fetch user paths for each day
-    user_paths_query = """
-    MATCH (u:Resource)-[:CORR]->(batch:BatchInstance)-[r1:DF_BATCH_RESOURCE]->(nextBatch:BatchInstance)<-[:CORR]-(u)
+def group_high_level_batches(edges):
+    # HighLevelBatch groupings of one resource-day from its DF_BATCH_RESOURCE edges, given as
+    # (batch_number, activity, next_batch_number, next_activity) rows. This is the outcome of
+    # the former per-edge builder computed at once: every batch on an edge gets a node,
+    # batches connected in both directions end up in the same node, and a node keeps the
+    # activities of all its batches. The outcome does not depend on the edge order, so it
+    # reduces to union-find over the batch numbers of reciprocal edges.
+    parent = {}
+    activities = {}
+
+    def find(batch_number):
+        while parent[batch_number] != batch_number:
+            parent[batch_number] = parent[parent[batch_number]]
+            batch_number = parent[batch_number]
+        return batch_number
+
+    pairs = set()
+    for batch_number, activity, next_batch_number, next_activity in edges:
+        for number, name in ((batch_number, activity), (next_batch_number, next_activity)):
+            if number not in parent:
+                parent[number] = number
+                activities[number] = name
+        pairs.add((batch_number, next_batch_number))
+
+    for batch_number, next_batch_number in pairs:
+        if (next_batch_number, batch_number) in pairs:
+            root, next_root = find(batch_number), find(next_batch_number)
+            if root != next_root:
+                parent[root] = next_root
+
+    groups = {}
+    for number in parent:
+        groups.setdefault(find(number), []).append(number)
+    return [(sorted(numbers), sorted({activities[number] for number in numbers}))
+            for numbers in groups.values()]
+
+def create_high_level_batches_in_memory(tx, start_date=None, end_date=None):
+    # The batch DF graph is read once ordered by resource-day, grouped in Python and
+    # written back in bulk. With a date range only the BatchInstances of those days are read.
+    user_paths_query = f"""
+    MATCH (batch:BatchInstance)
+    WHERE {in_timestamp_range("batch.earliest_timestamp", start_date, end_date)}
+    MATCH (u:Resource)-[:CORR]->(batch)-[r1:DF_BATCH_RESOURCE]->(nextBatch:BatchInstance)<-[:CORR]-(u)
     WHERE batch <> nextBatch AND u.sysId = r1.sysId
-    RETURN u, batch, nextBatch, date(batch.earliest_timestamp) AS eventDate, r1.sysId AS sysId, r1.count AS count1, r1.order
-    ORDER BY r1.order
-
+    RETURN r1.sysId AS sysId, date(batch.earliest_timestamp) AS eventDate,
+           batch.batch_number AS batch_number, batch.activity AS activity,
+           nextBatch.batch_number AS next_batch_number, nextBatch.activity AS next_activity
+    ORDER BY sysId, eventDate
     """
 
-    try:
-        user_paths_result = tx.run(user_paths_query)
-    except Exception as e:
-        print(f"Error running user paths query: {e}")
-        return
-    
-    hlb_count = 0
-    failed_count = 0
-    created_nodes = set()
-
-    try:
-        for record in user_paths_result:
-            sysId = record["sysId"]
-            eventDate = record["eventDate"]
-            batch = record["batch"]
-            next_batch = record["nextBatch"]
-
-            if batch and next_batch:
-                batch_number = batch["batch_number"]
-                next_batch_number = next_batch["batch_number"]
-
-                # Sort batch numbers in ascending order
-                sorted_batch_numbers = tuple(sorted([batch_number, next_batch_number]))
-
-                # Check if a node with the same sorted corr_batch_numbers already exists for the user
-                existing_node_query = """
-                MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                WHERE apoc.coll.sort(hlb.corr_batch_numbers) = $sorted_batch_numbers
-                RETURN hlb
-                """
-
-                try:
-                    existing_node_result = tx.run(existing_node_query, sysId=sysId, sorted_batch_numbers=sorted_batch_numbers)
-                    existing_node_record = existing_node_result.single()
-                except Exception as e:
-                    print(f"Error running existing node query: {e}")
-                    continue
-
-                if existing_node_record:
-                    # Node exists, skip processing
-                    created_nodes.add(sorted_batch_numbers)
-                    continue
-                else:
-                    # Check for a loop: batch -> nextBatch and nextBatch -> batch
-                    reverse_loop_query = """
-                    MATCH (u:Resource)-[:CORR]->(nextBatch:BatchInstance)-[r1:DF_BATCH_RESOURCE {sysId: $sysId}]->(batch:BatchInstance)<-[:CORR]-(u)
-                    MATCH (u)-[:CORR]->(batch)-[r2:DF_BATCH_RESOURCE {sysId: $sysId}]->(nextBatch)<-[:CORR]-(u)
-                    WHERE batch.batch_number = $batch_number
-                      AND nextBatch.batch_number = $next_batch_number
-                      AND r1.sysId = r2.sysId
-                    RETURN u, batch, nextBatch
-                    """
-
-                    try:
-                        reverse_loop_result = tx.run(reverse_loop_query, batch_number=batch_number, next_batch_number=next_batch_number, sysId=sysId)
-                        reverse_loop_exists = reverse_loop_result.single() is not None
-                    except Exception as e:
-                        print(f"Error running reverse loop query: {e}")
-                        continue
-
-                    if reverse_loop_exists:
-                        # There is a loop, check if individual nodes exist and merge into a joint node
-                        joint_activity_names = {batch["activity"], next_batch["activity"]}
-                        all_batches = set(sorted_batch_numbers)
-
-                        # Check if either batch is already part of a joint node or exists as an individual node
-                        existing_joint_or_individual_query = """
-                        MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                        WHERE ANY(batchNum IN hlb.corr_batch_numbers WHERE batchNum IN $sorted_batch_numbers)
-                        RETURN hlb
-                        """
-
-                        try:
-                            existing_joint_or_individual_result = tx.run(existing_joint_or_individual_query, sysId=sysId, sorted_batch_numbers=sorted_batch_numbers)
-                            existing_joint_or_individual_records = existing_joint_or_individual_result.data()
-                        except Exception as e:
-                            print(f"Error running existing joint or individual query: {e}")
-                            continue
-
-                        if existing_joint_or_individual_records:
-                            # Before merging, ensure no existing node has all these batch numbers
-                            fully_overlapping_query = """
-                            MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                            WHERE all(batchNum IN $sorted_batch_numbers WHERE batchNum IN hlb.corr_batch_numbers)
-                            RETURN hlb
-                            """
-                            try:
-                                fully_overlapping_result = tx.run(fully_overlapping_query, sysId=sysId, sorted_batch_numbers=sorted_batch_numbers)
-                                fully_overlapping_record = fully_overlapping_result.single()
-                            except Exception as e:
-                                print(f"Error checking fully overlapping nodes: {e}")
-                                continue
-
-                            if fully_overlapping_record:
-                                # Fully overlapping node exists, skip creation
-                                continue
-
-                            merged_batches = set()
-                            merged_activities = set()
-                            for rec in existing_joint_or_individual_records:
-                                existing_node = rec['hlb']
-                                merged_batches.update(existing_node['corr_batch_numbers'])
-                                merged_activities.update(existing_node['activity_name'])
-
-                            # Update with new batches and activities
-                            merged_batches.update(all_batches)
-                            merged_activities.update(joint_activity_names)
-
-                            # Update the merged node
-                            update_existing_query = """
-                            MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                            WHERE ANY(batchNum IN hlb.corr_batch_numbers WHERE batchNum IN $sorted_batch_numbers)
-                            SET hlb.corr_batch_numbers = $merged_batches,
-                                hlb.activity_name = $merged_activities
-                            RETURN hlb
-                            """
-                            try:
-                                hlb_result = tx.run(update_existing_query, sysId=sysId, sorted_batch_numbers=sorted_batch_numbers, merged_batches=list(merged_batches), merged_activities=list(merged_activities))
-                                hlb_record = hlb_result.single()
-                            except Exception as e:
-                                print(f"Error updating existing node: {e}")
-                                failed_count += 1
-                                continue
-                        else:
-                            # Create a new joint node
-                            joint_node_query = """
-                            MERGE (hlb:HighLevelBatch {sysId: $sysId, corr_batch_numbers: $sorted_batch_numbers})
-                            ON CREATE SET hlb.activity_name = $joint_activity_names,
-                                          hlb.date = $eventDate
-                            RETURN hlb
-                            """
-                            try:
-                                hlb_result = tx.run(joint_node_query, sysId=sysId, sorted_batch_numbers=sorted_batch_numbers, joint_activity_names=list(joint_activity_names), eventDate=eventDate)
-                                hlb_record = hlb_result.single()
-                            except Exception as e:
-                                print(f"Error creating or merging joint node: {e}")
-                                failed_count += 1
-                                continue
-
-                            if hlb_record:
-                                created_nodes.add(sorted_batch_numbers)
-                                hlb_count += 1
-                                print(f"Created or merged node: {hlb_record['hlb']}")
-                            else:
-                                failed_count += 1
-                    else:
-                        # Create individual nodes for non-loops
-                        for b in [batch, next_batch]:
-                            batch_number = b["batch_number"]
-                            activity_name = b["activity"]
-
-                            # Check if this new node participates in any joint node
-                            existing_joint_query = """
-                            MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                            WHERE $batch_number IN hlb.corr_batch_numbers
-                            RETURN hlb
-                            """
-                            try:
-                                existing_joint_result = tx.run(existing_joint_query, sysId=sysId, batch_number=batch_number)
-                                existing_joint_record = existing_joint_result.single()
-                            except Exception as e:
-                                print(f"Error running existing joint query: {e}")
-                                continue
-                            
-                            if existing_joint_record:
-                                # Append this node to the existing joint node
-                                update_joint_query = """
-                                MATCH (hlb:HighLevelBatch {sysId: $sysId})
-                                WHERE $batch_number IN hlb.corr_batch_numbers
-                                SET hlb.corr_batch_numbers = apoc.coll.union(hlb.corr_batch_numbers, [$batch_number]),
-                                    hlb.activity_name = apoc.coll.union(hlb.activity_name, [$activity_name])
-                                RETURN hlb
-                                """
-                                try:
-                                    update_joint_result = tx.run(update_joint_query, sysId=sysId, batch_number=batch_number, activity_name=activity_name)
-                                    hlb_record = update_joint_result.single()
-                                except Exception as e:
-                                    print(f"Error updating joint node: {e}")
-                                    failed_count += 1
-                                    continue
-                            else:
-                                # Check if there is another individual node with the same batch id
-                                existing_individual_query = """
-                                MATCH (hlb:HighLevelBatch {sysId: $sysId, corr_batch_numbers: [$batch_number]})
-                                RETURN hlb
-                                """
-                                try:
-                                    existing_individual_result = tx.run(existing_individual_query, sysId=sysId, batch_number=batch_number)
-                                    existing_individual_record = existing_individual_result.single()
-                                except Exception as e:
-                                    print(f"Error running existing individual query: {e}")
-                                    continue
-                                
-                                if existing_individual_record:
-                                    continue  # Skip creation if an individual node already exists
-                                
-                                # Create a new individual HighLevelBatch node
-                                individual_node_query = """
-                                MERGE (hlb:HighLevelBatch {
-                                    sysId: $sysId,
-                                    activity_name: [$activity_name],
-                                    corr_batch_numbers: [$batch_number]
-                                })
-                                ON CREATE SET hlb.date = $eventDate
-                                RETURN hlb
-                                """
-                                try:
-                                    individual_node_result = tx.run(individual_node_query, sysId=sysId, activity_name=activity_name, batch_number=batch_number, eventDate=eventDate)
-                                    hlb_record = individual_node_result.single()
-                                except Exception as e:
-                                    print(f"Error creating individual node: {e}")
-                                    failed_count += 1
-                                    continue
-                            
-                            if hlb_record:
-                                hlb_count += 1
-                                created_nodes.add(tuple(sorted([batch_number])))
-                                print(f"Created node: {hlb_record['hlb']}")
-                            else:
-                                failed_count += 1
-    except Exception as e:
-        print(f"Error processing user paths result: {e}")
-    
-    # Handle resources with only one batch instance in a day
-    single_batch_query = """
-    MATCH (u:Resource)-[:CORR]->(batch:BatchInstance)
+    single_batch_query = f"""
+    MATCH (batch:BatchInstance)
+    WHERE {in_timestamp_range("batch.earliest_timestamp", start_date, end_date)}
+    MATCH (u:Resource)-[:CORR]->(batch)
     WHERE u.sysId IN batch.users
     WITH u, batch, date(batch.earliest_timestamp) AS eventDate
     WITH u, eventDate, COUNT(batch) AS batchCount, COLLECT(batch) AS batches
     WHERE batchCount = 1
     UNWIND batches AS batch
-    RETURN u, batch, eventDate, u.sysId AS sysId
+    RETURN u.sysId AS sysId, eventDate, batch.batch_number AS batch_number, batch.activity AS activity
     """
 
+    bounds = timestamp_bounds(tx, start_date, end_date)
+    rows = []
     try:
-        single_batch_result = tx.run(single_batch_query)
+        result = tx.run(user_paths_query, **bounds)
+        for (sysId, eventDate), day_edges in groupby(result, key=lambda record: (record["sysId"], record["eventDate"])):
+            edges = [(record["batch_number"], record["activity"], record["next_batch_number"], record["next_activity"])
+                     for record in day_edges]
+            for batch_numbers, activity_names in group_high_level_batches(edges):
+                rows.append({"sysId": sysId, "date": eventDate,
+                             "corr_batch_numbers": batch_numbers, "activity_name": activity_names})
     except Exception as e:
-        print(f"Error running single batch query: {e}")
+        print(f"Error running user paths query: {e}")
         return
 
+    # Handle resources with only one batch instance in a day
+    individual_nodes = {(row["sysId"], tuple(row["corr_batch_numbers"])) for row in rows}
     try:
-        for record in single_batch_result:
-            sysId = record["sysId"]
-            eventDate = record["eventDate"]
-            batch = record["batch"]
-
-            if (sysId, eventDate) not in created_nodes:
-                batch_number = batch["batch_number"]
-                activity_name = batch["activity"]
-
-                # Check if an individual node already exists
-                existing_individual_query = """
-                MATCH (hlb:HighLevelBatch {sysId: $sysId, corr_batch_numbers: [$batch_number]})
-                RETURN hlb
-                """
-                try:
-                    existing_individual_result = tx.run(existing_individual_query, sysId=sysId, batch_number=batch_number)
-                    existing_individual_record = existing_individual_result.single()
-                except Exception as e:
-                    print(f"Error running existing individual query: {e}")
-                    continue
-                
-                if existing_individual_record:
-                    continue  # Skip creation if an individual node already exists
-
-                # Create a new individual HighLevelBatch node
-                individual_node_query = """
-                MERGE (hlb:HighLevelBatch {
-                    sysId: $sysId,
-                    activity_name: [$activity_name],
-                    corr_batch_numbers: [$batch_number]
-                })
-                ON CREATE SET hlb.date = $eventDate
-                RETURN hlb
-                """
-                try:
-                    individual_node_result = tx.run(individual_node_query, sysId=sysId, activity_name=activity_name, batch_number=batch_number, eventDate=eventDate)
-                    hlb_record = individual_node_result.single()
-                except Exception as e:
-                    print(f"Error creating individual node: {e}")
-                    failed_count += 1
-                    continue
-                
-                if hlb_record:
-                    hlb_count += 1
-                    created_nodes.add(tuple(sorted([batch_number])))
-                    print(f"Created individual node: {hlb_record['hlb']}")
-                else:
-                    failed_count += 1
+        for record in tx.run(single_batch_query, **bounds):
+            key = (record["sysId"], (record["batch_number"],))
+            if key not in individual_nodes:
+                individual_nodes.add(key)
+                rows.append({"sysId": record["sysId"], "date": record["eventDate"],
+                             "corr_batch_numbers": [record["batch_number"]], "activity_name": [record["activity"]]})
     except Exception as e:
-        print(f"Error processing single batch result: {e}")
-
-
-    print(f"Created or merged {hlb_count} HighLevelBatch nodes.")
-    print(f"Failed to create {failed_count} HighLevelBatch nodes.")
+        print(f"Error running single batch query: {e}")
+        return
 
-def drop_duplicate_high_level_batches(tx):
-    # Step 1: Identify duplicated nodes based on sysId, date, and corr_batch_numbers
-    duplicate_query = """
+    create_query = """
+    UNWIND $rows AS row
+    CREATE (hlb:HighLevelBatch {
+        sysId: row.sysId,
+        activity_name: row.activity_name,
+        corr_batch_numbers: row.corr_batch_numbers,
+        date: row.date
+    })
+    SET hlb.batch_key = """ + HLB_KEY.format(hlb="hlb") + """
+    """
+    hlb_count = 0
+    for chunk in chunked(rows, HLB_CHUNK_SIZE):
+        tx.run(create_query, rows=chunk)
+        hlb_count += len(chunk)
+
+    print(f"Created {hlb_count} HighLevelBatch nodes.")
+
+def drop_duplicate_high_level_batches(tx, start_date=None, end_date=None):
+    # Duplicates share sysId, date and corr_batch_numbers. The first node of every group is
+    # kept and the others are deleted in bulk, one write per chunk of ids. Nodes created by
+    # create_high_level_batches_in_memory are unique by batch_key, so this is only needed for
+    # the kept days of graphs built before batch_key existed.
+    duplicate_query = f"""
             MATCH (hlb:HighLevelBatch)
+            WHERE {in_date_range("hlb.date", start_date, end_date)}
             WITH hlb.sysId AS sysId, hlb.date AS date, hlb.corr_batch_numbers AS corr_batch_numbers, collect(hlb) AS nodes
             WHERE size(nodes) > 1
-            RETURN sysId, date, corr_batch_numbers, nodes
+            UNWIND tail(nodes) AS duplicate
+            RETURN id(duplicate) AS node_id
+    """
+
+    delete_query = """
+            UNWIND $node_ids AS node_id
+            MATCH (hlb:HighLevelBatch)
+            WHERE id(hlb) = node_id
+            DETACH DELETE hlb
     """
 
     try:
-        duplicates_result = tx.run(duplicate_query)
+        node_ids = [record["node_id"] for record in tx.run(duplicate_query, start_date=start_date, end_date=end_date)]
     except Exception as e:
         print(f"Error running duplicate query: {e}")
         return
-    
-    try:
-        for record in duplicates_result:
-            nodes = record["nodes"]
-            node_to_keep = nodes.pop(0)
-            for node in nodes:
-                delete_query = """
-                MATCH (hlb:HighLevelBatch)
-                WHERE id(hlb) = $node_id
-                DETACH DELETE hlb
-                """
-                try:
-                    tx.run(delete_query, node_id=node.id)
-                    print(f"Deleted duplicate node with ID: {node.id}")
-                except Exception as e:
-                    print(f"Error deleting duplicate node with ID {node.id}: {e}")
-    except Exception as e:
-        print(f"Error processing duplicates result: {e}")
 
-    print("Duplicate nodes removal completed.")
+    for chunk in chunked(node_ids, DUPLICATE_CHUNK_SIZE):
+        try:
+            tx.run(delete_query, node_ids=chunk)
+        except Exception as e:
+            print(f"Error deleting duplicate nodes {chunk[0]}..{chunk[-1]}: {e}")
 
-def connect_high_level_batch_to_batch_instances(tx):
-        tx.run("""
+    print(f"Duplicate nodes removal completed, {len(node_ids)} nodes deleted.")
+
+def connect_high_level_batch_to_batch_instances(tx, start_date=None, end_date=None):
+        tx.run(f"""
             CALL apoc.periodic.iterate(
-            "MATCH (hlb:HighLevelBatch) RETURN hlb",
+            "MATCH (hlb:HighLevelBatch) WHERE {in_date_range("hlb.date", start_date, end_date)} RETURN hlb",
             "UNWIND hlb.corr_batch_numbers AS id_val MATCH (batch:BatchInstance) WHERE id_val = batch.batch_number MERGE (batch)-[:CORR]->(hlb)",
-            {batchSize:100})
+            {{batchSize:100, params: {{start_date: $start_date, end_date: $end_date}}}})
 
-        """)
+        """, start_date=start_date, end_date=end_date)
 
-def create_df_high_level_batch_edges(tx):       
-    query = """
+def create_df_high_level_batch_edges(tx, start_date=None, end_date=None):
+    # In an incremental run every edge touching a rebuilt node was removed with it, so the
+    # edges with at least one end in the date range are recreated and the others are kept.
+    # Those edges are reached from the HighLevelBatch nodes of the range, once from their
+    # source and once from their target when the source lies outside the range.
+    if start_date is None and end_date is None:
+        pattern = """
             MATCH (batch1:BatchInstance)-[r:DF_BATCH_RESOURCE]->(batch2:BatchInstance)
             MATCH (batch1)-[:CORR]->(hlb1:HighLevelBatch)
             MATCH (batch2)-[:CORR]->(hlb2:HighLevelBatch)
+        """
+    else:
+        pattern = f"""
+            CALL {{
+                MATCH (hlb1:HighLevelBatch)
+                WHERE {in_date_range("hlb1.date", start_date, end_date)}
+                MATCH (batch1:BatchInstance)-[:CORR]->(hlb1)
+                MATCH (batch1)-[r:DF_BATCH_RESOURCE]->(batch2:BatchInstance)-[:CORR]->(hlb2:HighLevelBatch)
+                RETURN hlb1, hlb2, r
+                UNION ALL
+                MATCH (hlb2:HighLevelBatch)
+                WHERE {in_date_range("hlb2.date", start_date, end_date)}
+                MATCH (batch2:BatchInstance)-[:CORR]->(hlb2)
+                MATCH (hlb1:HighLevelBatch)<-[:CORR]-(batch1:BatchInstance)-[r:DF_BATCH_RESOURCE]->(batch2)
+                WHERE NOT {in_date_range("hlb1.date", start_date, end_date)}
+                RETURN hlb1, hlb2, r
+            }}
+        """
+    query = pattern + """
+            WITH hlb1, hlb2, r
             WHERE hlb1 <> hlb2
             AND hlb1.sysId = hlb2.sysId
             AND hlb1.sysId = r.sysId
@@ -388,134 +279,172 @@ def create_df_high_level_batch_edges(tx):
             ON CREATE SET r2.count = r.count, r2.order = r.order
             ON MATCH SET r2.count = r2.count + r.count
     """
-    result = tx.run(query)
+    result = tx.run(query, start_date=start_date, end_date=end_date)
     print(f"Created DF_HIGH_LEVEL_BATCH edges.")
     
 
-def extend_and_cleanup_high_level_batches(tx):
-    # Identify iterations
-    loop_query = """
+def plan_loop_merges(edges):
+    # Extend/delete decisions for the loops of one resource-day DF_HIGH_LEVEL_BATCH graph,
+    # given as {(source, target): order}. Reciprocal pairs form chains of mutually connected
+    # nodes that are collapsed one pair at a time, in the order of their first edge:
+    # - the node with DF edges to other nodes than its partner is extended (source first),
+    # - otherwise the source of the lower-order edge is extended,
+    # - the other node is deleted together with its DF edges.
+    # Pairs whose node was already merged are resolved to the surviving node, so no node is
+    # deleted without being merged into another one.
+    unordered = [edge for edge, order in edges.items() if order is None]
+    if unordered:
+        raise ValueError(f"DF_HIGH_LEVEL_BATCH edges without order: {unordered}")
+
+    outgoing, incoming = {}, {}
+    for source, target in edges:
+        outgoing.setdefault(source, set()).add(target)
+        incoming.setdefault(target, set()).add(source)
+
+    # Every reciprocal pair is taken once, from its lower-order edge, or from the lower
+    # source id when both edges have the same order
+    pairs = sorted((min(order, edges[target, source]), source, target)
+                   for (source, target), order in edges.items()
+                   if (target, source) in edges and (order, source) < (edges[target, source], target))
+
+    survivor = {}
+
+    def resolve(node):
+        while node in survivor:
+            node = survivor[node]
+        return node
+
+    merges = []
+    for _, hlb1, hlb2 in pairs:
+        hlb1, hlb2 = resolve(hlb1), resolve(hlb2)
+        if hlb1 == hlb2:
+            continue
+        if outgoing.get(hlb1, set()) - {hlb2}:
+            extend_node, delete_node = hlb1, hlb2
+        elif outgoing.get(hlb2, set()) - {hlb1}:
+            extend_node, delete_node = hlb2, hlb1
+        elif edges.get((hlb2, hlb1), float('inf')) < edges.get((hlb1, hlb2), float('inf')):
+            extend_node, delete_node = hlb2, hlb1
+        else:
+            extend_node, delete_node = hlb1, hlb2
+
+        survivor[delete_node] = extend_node
+        merges.append((extend_node, delete_node))
+        # DETACH DELETE drops the DF edges of the deleted node
+        for target in outgoing.pop(delete_node, set()):
+            incoming[target].discard(delete_node)
+        for source in incoming.pop(delete_node, set()):
+            outgoing[source].discard(delete_node)
+
+    return [(resolve(extend_node), delete_node) for extend_node, delete_node in merges]
+
+def extend_and_cleanup_high_level_batches(tx, start_date=None, end_date=None):
+    # Loops are collapsed per (sysId, date) in memory and all merges are applied in one
+    # bulk write, instead of per-pair lookups over a stale list of reciprocal pairs
+    if start_date is None and end_date is None:
+        pattern = """
         MATCH (hlb1:HighLevelBatch)-[r:DF_HIGH_LEVEL_BATCH]->(hlb2:HighLevelBatch)
-        MATCH (hlb2)-[r1:DF_HIGH_LEVEL_BATCH]->(hlb1)
-        WHERE hlb1.sysId = hlb2.sysId and r.sysId=r1.sysId
-        RETURN hlb1, hlb2, r, r1
+        """
+    else:
+        # Edges with at least one end in the date range, reached from the indexed dates
+        pattern = f"""
+        CALL {{
+            MATCH (hlb1:HighLevelBatch)
+            WHERE {in_date_range("hlb1.date", start_date, end_date)}
+            MATCH (hlb1)-[r:DF_HIGH_LEVEL_BATCH]->(hlb2:HighLevelBatch)
+            RETURN hlb1, hlb2, r
+            UNION ALL
+            MATCH (hlb2:HighLevelBatch)
+            WHERE {in_date_range("hlb2.date", start_date, end_date)}
+            MATCH (hlb1:HighLevelBatch)-[r:DF_HIGH_LEVEL_BATCH]->(hlb2)
+            WHERE NOT {in_date_range("hlb1.date", start_date, end_date)}
+            RETURN hlb1, hlb2, r
+        }}
+        """
+    graph_query = pattern + """
+        WITH hlb1, hlb2, r
+        WHERE hlb1.sysId = hlb2.sysId AND r.sysId = hlb1.sysId
+        RETURN hlb1.sysId AS sysId, hlb1.date AS date, r.order AS order,
+               id(hlb1) AS source, hlb1.corr_batch_numbers AS source_batches, hlb1.activity_name AS source_activities,
+               id(hlb2) AS target, hlb2.corr_batch_numbers AS target_batches, hlb2.activity_name AS target_activities
+        ORDER BY sysId, date
     """
 
-    try:
-        loop_result = tx.run(loop_query)
-    except Exception as e:
-        print(f"Error running loop query: {e}")
-        return
-
-    try:
-        for record in loop_result:
-            hlb1 = record["hlb1"]
-            hlb2 = record["hlb2"]
-            r = record["r"]
-            r1 = record["r1"]
-
-            # Determine which node to extend and which to delete
-            extend_node = None
-            delete_node = None
-
-            # Check which node has additional edges not part of the loop for the same resource
-            additional_edges_query = """
-            MATCH (hlb:HighLevelBatch)-[r:DF_HIGH_LEVEL_BATCH]->(other:HighLevelBatch)
-            WHERE id(hlb) = $node_id AND id(other) <> $other_id
-            AND hlb.sysId = other.sysId
-            RETURN COUNT(r) AS additional_edges
-            """
-
-            try:
-                hlb1_edges_result = tx.run(additional_edges_query, node_id=hlb1.id, other_id=hlb2.id)
-                hlb2_edges_result = tx.run(additional_edges_query, node_id=hlb2.id, other_id=hlb1.id)
-                hlb1_additional_edges = hlb1_edges_result.single()["additional_edges"]
-                hlb2_additional_edges = hlb2_edges_result.single()["additional_edges"]
-
-                if hlb1_additional_edges > 0:
-                    extend_node = hlb1
-                    delete_node = hlb2
-                elif hlb2_additional_edges > 0:
-                    extend_node = hlb2
-                    delete_node = hlb1
-                else:
-                    # If both have no additional edges, choose the node with the smaller order attribute to extend
-                    if r["order"] < r1["order"]:
-                        extend_node = hlb1
-                        delete_node = hlb2
-                    else:
-                        extend_node = hlb2
-                        delete_node = hlb1
-
-                if extend_node and delete_node:
-                    # Extend the extend_node with data from delete_node
-                    extend_query = """
-                    MATCH (extend:HighLevelBatch)
-                    WHERE id(extend) = $extend_id
-                    MATCH (delete:HighLevelBatch)<-[:CORR]-(del_batch:BatchInstance)
-                    WHERE id(delete) = $delete_id
-                    MERGE (del_batch)-[:CORR]->(extend)
-                    WITH extend, delete
-                    // Extend properties of extend node
-                    SET extend.corr_batch_numbers = apoc.coll.union(extend.corr_batch_numbers, delete.corr_batch_numbers),
-                        extend.activity_name = extend.activity_name + apoc.coll.toSet(delete.activity_name)
-                    """
-        
-                    try:
-                        tx.run(extend_query, extend_id=extend_node.id, delete_id=delete_node.id)
-                    except Exception as e:
-                        print(f"Error extending node {extend_node.id} with data from node {delete_node.id}: {e}")
-                        continue
-
-                    # Delete the delete_node and its edges
-                    delete_query = """
-                    MATCH (delete:HighLevelBatch)
-                    WHERE id(delete) = $delete_id
-                    DETACH DELETE delete
-                    """
-
-                    try:
-                        tx.run(delete_query, delete_id=delete_node.id)
-                        print(f"Deleted node {delete_node.id}")
-                    except Exception as e:
-                        print(f"Error deleting node {delete_node.id}: {e}")
-                        continue
-
-            except Exception as e:
-                print(f"Error determining additional edges: {e}")
-                continue
-
-    except Exception as e:
-        print(f"Error processing loop result: {e}")
+    # Errors are not caught here: a partial plan would silently skip the merges of every
+    # later resource-day, so the transaction fails as a whole instead
+    graph_result = tx.run(graph_query, start_date=start_date, end_date=end_date)
+
+    merges = []
+    for _, day_records in groupby(graph_result, key=lambda record: (record["sysId"], record["date"])):
+        edges, nodes = {}, {}
+        for record in day_records:
+            edges[(record["source"], record["target"])] = record["order"]
+            nodes[record["source"]] = (record["source_batches"], record["source_activities"])
+            nodes[record["target"]] = (record["target_batches"], record["target_activities"])
+
+        extended = {}
+        for extend_id, delete_id in plan_loop_merges(edges):
+            if extend_id not in extended:
+                batches, activities = nodes[extend_id]
+                extended[extend_id] = {"extend_id": extend_id, "delete_ids": [],
+                                       "corr_batch_numbers": set(batches), "activity_name": list(activities)}
+            merge = extended[extend_id]
+            batches, activities = nodes[delete_id]
+            merge["delete_ids"].append(delete_id)
+            merge["corr_batch_numbers"].update(batches)
+            merge["activity_name"] += list(dict.fromkeys(activities))
+        for merge in extended.values():
+            merge["corr_batch_numbers"] = sorted(merge["corr_batch_numbers"])
+            merges.append(merge)
+
+    merge_query = """
+        UNWIND $merges AS merge
+        MATCH (extend:HighLevelBatch) WHERE id(extend) = merge.extend_id
+        SET extend.corr_batch_numbers = merge.corr_batch_numbers,
+            extend.activity_name = merge.activity_name
+        WITH extend, merge
+        UNWIND merge.delete_ids AS delete_id
+        MATCH (delete:HighLevelBatch) WHERE id(delete) = delete_id
+        OPTIONAL MATCH (delete)<-[:CORR]-(del_batch:BatchInstance)
+        WITH extend, delete, collect(del_batch) AS del_batches
+        FOREACH (del_batch IN del_batches | MERGE (del_batch)-[:CORR]->(extend))
+        DETACH DELETE delete
+        WITH DISTINCT extend
+        // Keep the uniqueness key in line with the extended batch numbers
+        SET extend.batch_key = CASE WHEN extend.batch_key IS NULL THEN NULL ELSE """ + HLB_KEY.format(hlb="extend") + """ END
+    """
 
+    tx.run(merge_query, merges=merges)
+    print(f"Deleted {sum(len(merge['delete_ids']) for merge in merges)} nodes merged into {len(merges)} nodes.")
     print("Extended and cleaned up HighLevelBatch nodes in loops.")
 
-def connect_high_level_batch_to_resource(tx):
-        tx.run("""
+def connect_high_level_batch_to_resource(tx, start_date=None, end_date=None):
+        tx.run(f"""
             CALL apoc.periodic.iterate(
-            "MATCH (hlb:HighLevelBatch) RETURN hlb",
+            "MATCH (hlb:HighLevelBatch) WHERE {in_date_range("hlb.date", start_date, end_date)} RETURN hlb",
             "UNWIND hlb.sysId AS id_val MATCH (u:Resource) WHERE id_val = u.sysId MERGE (u)-[:CORR]->(hlb)",
-            {batchSize:100})
+            {{batchSize:100, params: {{start_date: $start_date, end_date: $end_date}}}})
 
-        """)
+        """, start_date=start_date, end_date=end_date)
     
-def connect_high_level_batch_to_events(tx):
-        tx.run("""
+def connect_high_level_batch_to_events(tx, start_date=None, end_date=None):
+        tx.run(f"""
             CALL apoc.periodic.iterate(
-            "MATCH (hlb:HighLevelBatch) RETURN hlb",
+            "MATCH (hlb:HighLevelBatch) WHERE {in_date_range("hlb.date", start_date, end_date)} RETURN hlb",
             "UNWIND hlb.corr_batch_numbers AS id_val 
             MATCH (e:Event) WHERE id_val = e.batch 
             MATCH (u:Resource)<-[:CORR]-(e)
             WHERE hlb.sysId = u.sysId
             MERGE (e)-[:CORR]->(hlb)",
-            {batchSize: 100})
+            {{batchSize: 100, params: {{start_date: $start_date, end_date: $end_date}}}})
 
-        """)
+        """, start_date=start_date, end_date=end_date)
 
-def add_high_level_batches_attributes(tx):
-    add_attributes = """
+def add_high_level_batches_attributes(tx, start_date=None, end_date=None):
+    add_attributes = f"""
             MATCH (hlb:HighLevelBatch)
             WHERE hlb.corr_batch_numbers IS NOT NULL AND hlb.sysId IS NOT NULL
+              AND {in_date_range("hlb.date", start_date, end_date)}
             WITH hlb, hlb.corr_batch_numbers AS batch_numbers, hlb.sysId AS sysId
             MATCH (u:Resource {sysId: sysId})<-[:CORR]-(e:Event)
             WHERE e.batch IN batch_numbers
@@ -528,62 +457,76 @@ def add_high_level_batches_attributes(tx):
     """
 
     try:
-        result = tx.run(add_attributes)
+        result = tx.run(add_attributes, start_date=start_date, end_date=end_date)
         for record in result:
             hlb = record["hlb"]
             print(f"Updated HighLevelBatch node {hlb['sysId']} with timestamps and event count.")
     except Exception as e:
         print(f"Error updating HighLevelBatch nodes: {e}") 
 
-def set_work_together_attribute(tx):
+def set_work_together_attribute(tx, start_date=None, end_date=None):
     # Update nodes that satisfy the condition
-    tx.run("""
+    tx.run(f"""
         MATCH (n:HighLevelBatch)<-[:CORR]-(m:BatchInstance)
-        WHERE n.sysId IN m.users
+        WHERE n.sysId IN m.users AND {in_date_range("n.date", start_date, end_date)}
         WITH n, collect(m) AS batchInstances, [m IN collect(m) WHERE ANY(x IN m.users WHERE x <> n.sysId)] AS filteredBatchInstances
         WHERE size(filteredBatchInstances) > 0
         SET n.workTogether = true
         RETURN n
-    """)
+    """, start_date=start_date, end_date=end_date)
     
     # Update nodes that do not satisfy the condition
-    tx.run("""
+    tx.run(f"""
         MATCH (n:HighLevelBatch)
-        WHERE n.workTogether IS NULL
+        WHERE n.workTogether IS NULL AND {in_date_range("n.date", start_date, end_date)}
         SET n.workTogether = false
         RETURN n
-    """)
+    """, start_date=start_date, end_date=end_date)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="High-level batch aggregation")
+    parser.add_argument("--start-date", type=date.fromisoformat,
+                        help="first day (YYYY-MM-DD) to rebuild, HighLevelBatch nodes of other days are kept")
+    parser.add_argument("--end-date", type=date.fromisoformat,
+                        help="last day (YYYY-MM-DD) to rebuild, HighLevelBatch nodes of other days are kept")
+    parser.add_argument("--drop-duplicates", action="store_true",
+                        help="also delete duplicated HighLevelBatch nodes kept from a graph built before batch_key")
+    args = parser.parse_args()
+    # Without dates the full history is aggregated again
+    dates = (args.start_date, args.end_date)
+
     with driver.session() as session:
+        # Unique HighLevelBatch keys and an index on their dates
+        session.execute_write(create_high_level_batch_indexes)
         # Delete existing HighLevelBatch nodes and edges
-        session.execute_write(delete_high_level_batches)
+        session.execute_write(delete_high_level_batches, *dates)
+        if args.drop_duplicates:
+            # Deletion of duplicated HighLevelBatch nodes on the days that are kept
+            session.execute_write(drop_duplicate_high_level_batches)
+            print("Query to duplicates deletion executed.")
         # Create HighLevelBatch nodes
-        session.execute_write(create_high_level_batches_v2)
-        # Deletion of duplicated HighLevelBatch nodes
-        session.execute_write(drop_duplicate_high_level_batches)
-        print("Query to duplicates deletion executed.")
+        session.execute_write(create_high_level_batches_in_memory, *dates)
         # Connect HighLevelBatch to BatchInstance based on resource sysId
-        session.execute_write(connect_high_level_batch_to_batch_instances)
+        session.execute_write(connect_high_level_batch_to_batch_instances, *dates)
         print("Query to connect BatchInstance to HighLevelBatch executed.")
         # Create DF edges 
-        session.execute_write(create_df_high_level_batch_edges)
+        session.execute_write(create_df_high_level_batch_edges, *dates)
         print("Query to create DF_HIGH_LEVEL_BATCH edges executed.")
         # Extend and clean up HighLevelBatch nodes in iterative patterns
-        session.execute_write(extend_and_cleanup_high_level_batches)
+        session.execute_write(extend_and_cleanup_high_level_batches, *dates)
         print("Extended and cleaned up HighLevelBatch nodes in loops.")
         # Connect HighLevelBatch to Resource based on resource sysId
-        session.execute_write(connect_high_level_batch_to_resource)
+        session.execute_write(connect_high_level_batch_to_resource, *dates)
         print("Query to connect Resource to HighLevelBatch executed.")
         # Connect HighLevelBatch to Events based on resource sysId
-        session.execute_write(connect_high_level_batch_to_events)
+        session.execute_write(connect_high_level_batch_to_events, *dates)
         print("Query to connect Events to HighLevelBatch executed.")
         # Add attributes to HighLevelBatch nodes
-        session.execute_write(add_high_level_batches_attributes)
+        session.execute_write(add_high_level_batches_attributes, *dates)
         print("Added attributes to HighLevelBatch nodes.")
         # Set the workTogether attribute
-        session.execute_write(set_work_together_attribute)
+        session.execute_write(set_work_together_attribute, *dates)
         print("Set the workTogether attribute for HighLevelBatch nodes.")
 
 if __name__ == "__main__":
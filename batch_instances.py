@@ -0,0 +1,245 @@
+"""
+The code is dedicated for the fused BatchInstance construction shared by batching over resource
+(4.2) and batching over activity (5.2). Segmented events are aggregated into BatchInstance rows
+while they are streamed and written with their CORR edges in chunked UNWIND transactions, over
+one session or a small pool of writer threads.
+"""
+
+from dotenv import load_dotenv
+from itertools import islice
+import os
+import queue
+import threading
+
+load_dotenv()
+
+# Number of BatchInstance rows (with their CORR targets) per UNWIND write in the fused stage
+BATCH_INSTANCE_CHUNK_SIZE = int(os.getenv('BATCH_INSTANCE_CHUNK_SIZE') or 1000)
+# Report progress every PROGRESS_EVERY written rows
+PROGRESS_EVERY = 100000
+
+# Layout of the event tuples read by the fused stage, the fields used by the segmentation
+# followed by the raw timestamps, kit runs and the node ids of the kits and resources each
+# BatchInstance is correlated with
+FUSED_EVENT_FIELDS = ('id', 'activity', 'timestamp', 'resourceSysId',
+                      'rawTimestamp', 'kitId', 'runId', 'kitNodeId', 'resourceNodeId')
+FUSED_EVENTS_QUERY = """
+MATCH (u:Resource)<-[:CORR]-(e:Event)-[:CORR]->(k:Kit)
+RETURN id(e) AS id, e.activity AS activity, datetime(e.timestamp).epochMillis AS timestamp, u.sysId AS resourceSysId,
+       e.timestamp AS rawTimestamp, k.kitId AS kitId, k.runId AS runId, id(k) AS kitNodeId, id(u) AS resourceNodeId
+ORDER BY {order_by}
+"""
+
+
+def chunked(rows, chunk_size):
+    # Split any iterable of rows into lists of at most chunk_size rows
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchInstanceAggregate:
+    # Running aggregate of one batch, the properties shared by the BatchInstance nodes of 4.3 and 5.3
+    def __init__(self, batch_number, row):
+        self.batch_number = batch_number
+        self.activity = row['activity']
+        self.events = {}
+        self.kits = {}
+        self.kit_nodes = {}
+        self.runs = {}
+        self.resources = {}
+        self.earliest = self.latest = row
+
+    def add(self, row):
+        self.events[row['id']] = None
+        self.kits[row['kitId']] = None
+        self.kit_nodes[row['kitNodeId']] = None
+        if row['runId'] is not None:
+            self.runs[row['runId']] = None
+        self.resources[row['resourceNodeId']] = None
+        if row['timestamp'] < self.earliest['timestamp']:
+            self.earliest = row
+        if row['timestamp'] > self.latest['timestamp']:
+            self.latest = row
+
+    def properties(self):
+        kits = [kit for kit in self.kits if kit is not None]
+        return {
+            'batch_number': self.batch_number,
+            'activity': self.activity,
+            'kits': kits,
+            'kits_number': len(kits),
+            'runs': list(self.runs),
+            'earliest_timestamp': self.earliest['rawTimestamp'],
+            'latest_timestamp': self.latest['rawTimestamp'],
+        }
+
+    def to_row(self):
+        return {
+            'properties': self.properties(),
+            'events': list(self.events),
+            'kits': list(self.kit_nodes),
+            'resources': list(self.resources),
+        }
+
+
+class ResourceBatchInstanceAggregate(BatchInstanceAggregate):
+    # BatchInstance of batching over resource (4.3), one resource per batch
+    def __init__(self, batch_number, row):
+        super().__init__(batch_number, row)
+        self.resource_sys_id = row['resourceSysId']
+        self.event_count = 0
+
+    def add(self, row):
+        super().add(row)
+        self.event_count += 1
+
+    def properties(self):
+        return {
+            # Same key as the BatchInstance MERGE of 4.3
+            'batch_key': f"{self.batch_number}|{self.activity or ''}|{self.resource_sys_id or ''}",
+            **super().properties(),
+            'event_number': self.event_count,
+            'resource_sys_id': self.resource_sys_id,
+        }
+
+
+class ActivityBatchInstanceAggregate(BatchInstanceAggregate):
+    # BatchInstance of batching over activity (5.3), any number of users per batch
+    def __init__(self, batch_number, row):
+        super().__init__(batch_number, row)
+        self.users = {}
+
+    def add(self, row):
+        super().add(row)
+        self.users[row['resourceSysId']] = None
+
+    def properties(self):
+        users = [user for user in self.users if user is not None]
+        return {
+            # Same key as the BatchInstance MERGE of 5.3
+            'batch_key': f"{self.batch_number}|{self.activity or ''}",
+            **super().properties(),
+            'users': users,
+            'events_number': len(self.events),
+            'users_number': len(users),
+        }
+
+
+def aggregate_batch_instances(segmented, aggregate=BatchInstanceAggregate):
+    # Events of one batch are consecutive in processing order, so every batch is
+    # complete as soon as the next one starts and only one aggregate is kept in memory
+    current = None
+    for event, batch in segmented:
+        row = dict(zip(FUSED_EVENT_FIELDS, event))
+        if current is None or current.batch_number != batch:
+            if current is not None:
+                yield current.to_row()
+            current = aggregate(batch, row)
+        current.add(row)
+    if current is not None:
+        yield current.to_row()
+
+
+def delete_batch_instances(tx):
+    tx.run("""
+    CALL apoc.periodic.iterate(
+    "MATCH (n:BatchInstance) RETURN n",
+    "DETACH DELETE n",
+    {batchSize:10000})
+    """)
+
+
+def create_batch_instances(tx, rows):
+    tx.run("""
+    UNWIND $rows AS row
+    CREATE (n:BatchInstance)
+    SET n = row.properties
+    WITH n, row
+    CALL {
+        WITH n, row
+        UNWIND row.events AS event_id
+        MATCH (e:Event) WHERE id(e) = event_id
+        SET e.batch = n.batch_number
+        CREATE (e)-[:CORR]->(n)
+    }
+    CALL {
+        WITH n, row
+        UNWIND row.kits AS kit_id
+        MATCH (k:Kit) WHERE id(k) = kit_id
+        CREATE (k)-[:CORR]->(n)
+    }
+    CALL {
+        WITH n, row
+        UNWIND row.resources AS resource_id
+        MATCH (u:Resource) WHERE id(u) = resource_id
+        CREATE (u)-[:CORR]->(n)
+    }
+    """, rows=rows)
+
+
+def write_in_chunks(driver, rows, work, chunk_size=BATCH_INSTANCE_CHUNK_SIZE, workers=1, label='rows'):
+    # Rows are sent to work(tx, chunk) as UNWIND parameter lists of chunk_size rows
+    # over one reused session, or over a pool of `workers` sessions when workers > 1
+    if workers > 1:
+        return _write_in_chunks_concurrently(driver, rows, work, chunk_size, workers, label)
+
+    progress = {'written': 0, 'next_report': PROGRESS_EVERY}
+    with driver.session() as session:
+        for chunk in chunked(rows, chunk_size):
+            session.write_transaction(work, chunk)
+            _report_progress(progress, len(chunk), label)
+    return progress['written']
+
+
+def _write_in_chunks_concurrently(driver, rows, work, chunk_size, workers, label):
+    # The queue is bounded so that at most a few chunks are held in memory
+    chunks = queue.Queue(maxsize=workers * 2)
+    progress = {'written': 0, 'next_report': PROGRESS_EVERY}
+    lock = threading.Lock()
+    errors = []
+
+    def write_chunks():
+        with driver.session() as session:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if errors:
+                    # Keep draining the queue so the producer never blocks
+                    continue
+                try:
+                    session.write_transaction(work, chunk)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                with lock:
+                    _report_progress(progress, len(chunk), label)
+
+    threads = [threading.Thread(target=write_chunks) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in chunked(rows, chunk_size):
+            if errors:
+                break
+            chunks.put(chunk)
+    finally:
+        for _ in threads:
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return progress['written']
+
+
+def _report_progress(progress, written, label):
+    progress['written'] += written
+    if progress['written'] >= progress['next_report']:
+        print(f"Written {progress['written']} {label}...")
+        progress['next_report'] += PROGRESS_EVERY
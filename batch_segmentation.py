@@ -0,0 +1,90 @@
+"""
+The code is dedicated for the batch segmentation engine shared by batching over resource (4.2)
+and batching over activity (5.2). Events are passed as columns in processing order and a new
+batch starts whenever one of the grouping keys changes or the gap to the previous event
+reaches the gap threshold.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Default gap threshold of five minutes in epoch millis
+DEFAULT_GAP_MILLIS = 5 * 60 * 1000
+
+
+def encode(values):
+    # Categorical codes of a grouping column (resource sysIds, activity names, ...)
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return values
+    codes, _ = pd.factorize(values, use_na_sentinel=True)
+    return codes
+
+
+class BatchSegmenter:
+    def __init__(self, timestamps, keys=()):
+        # Key changes and gaps between consecutive events do not depend on the
+        # threshold, so they are computed once and reused by every segment() call
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.size = len(timestamps)
+        self.gaps = np.diff(timestamps)
+        self.key_change = np.zeros(max(self.size - 1, 0), dtype=bool)
+        for key in keys:
+            codes = encode(key)
+            self.key_change |= codes[1:] != codes[:-1]
+
+    def boundaries(self, gap_millis=DEFAULT_GAP_MILLIS):
+        # True for every event that opens a new batch
+        starts = np.ones(self.size, dtype=bool)
+        starts[1:] = self.key_change | (self.gaps >= gap_millis)
+        return starts
+
+    def segment(self, gap_millis=DEFAULT_GAP_MILLIS):
+        # Batch numbers starting from 1 in processing order
+        return np.cumsum(self.boundaries(gap_millis), dtype=np.int64)
+
+
+def segment_batches(timestamps, keys=(), gap_millis=DEFAULT_GAP_MILLIS):
+    return BatchSegmenter(timestamps, keys).segment(gap_millis)
+
+
+def segment_frame(frame, keys, gap_millis=DEFAULT_GAP_MILLIS, timestamp='timestamp'):
+    # DataFrame convenience wrapper, rows are expected in processing order
+    return segment_batches(frame[timestamp].to_numpy(), [frame[key].to_numpy() for key in keys], gap_millis)
+
+
+def batch_statistics(batches, kits=None):
+    # Batch count, size distribution and kits per batch for one segmentation
+    sizes = np.bincount(batches)[1:]
+    sizes = sizes[sizes > 0]
+    stats = {
+        'batch_count': len(sizes),
+        'mean_batch_size': sizes.mean() if len(sizes) else 0.0,
+        'median_batch_size': np.median(sizes) if len(sizes) else 0.0,
+        'p90_batch_size': np.percentile(sizes, 90) if len(sizes) else 0.0,
+        'max_batch_size': sizes.max() if len(sizes) else 0,
+        'single_event_batches': int((sizes == 1).sum()),
+    }
+    if kits is not None:
+        kit_codes = encode(kits)
+        known = kit_codes >= 0
+        width = max(kit_codes.max(initial=0) + 1, 1)
+        # Distinct (batch, kit) pairs, counted per batch
+        pairs = np.unique(batches[known] * width + kit_codes[known])
+        kits_per_batch = np.bincount(pairs // width)[1:]
+        kits_per_batch = kits_per_batch[kits_per_batch > 0]
+        stats['mean_kits_per_batch'] = kits_per_batch.mean() if len(kits_per_batch) else 0.0
+        stats['max_kits_per_batch'] = kits_per_batch.max() if len(kits_per_batch) else 0
+    return stats
+
+
+def sweep_gap_thresholds(frame, keys, gap_thresholds, timestamp='timestamp', kit='kitId'):
+    # Evaluates every gap threshold (in millis) over the same cached event columns,
+    # key changes and gaps are computed only once for the whole sweep
+    segmenter = BatchSegmenter(frame[timestamp].to_numpy(), [frame[key].to_numpy() for key in keys])
+    kits = frame[kit].to_numpy() if kit in frame else None
+    rows = []
+    for gap_millis in gap_thresholds:
+        stats = batch_statistics(segmenter.segment(gap_millis), kits)
+        rows.append({'gap_minutes': gap_millis / 60000, 'gap_millis': gap_millis, **stats})
+    return pd.DataFrame(rows)
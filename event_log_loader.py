@@ -0,0 +1,123 @@
+"""
+The code is dedicated for loading the raw event log of Company C (the CSV files in DIRECTORY_1)
+through a typed, columnar Parquet cache. Every CSV file is converted once into its own Parquet
+partition with categorical columns, later loads only convert new or changed files and read
+just the requested columns.
+"""
+
+from dotenv import load_dotenv
+from pandas.api.types import union_categoricals
+import pandas as pd
+import hashlib
+import json
+import os
+
+load_dotenv()
+
+# Directory of the Parquet partitions and their manifest
+EVENT_LOG_CACHE = os.getenv('EVENT_LOG_CACHE') or 'event_log_cache'
+MANIFEST = 'manifest.json'
+
+# Low-cardinality text columns of the event log are stored as categories
+CATEGORICAL_COLUMNS = [
+    'Fecha de seguimiento', 'Hora de seguimiento', 'Usuario', 'Nombre punto de control',
+    'Tipo de objeto', 'Código', 'Nombre / Descripción', 'Tipo de producción',
+]
+
+COLUMN_TYPES = {
+    **{column: 'category' for column in CATEGORICAL_COLUMNS},
+    'Es preliminar': 'float32',
+    'Es físico': 'float32',
+    'Es denegado': 'float32',
+    'Cant.': 'Int32',
+    'N/S': 'float32',
+    'Nombre producción': 'Float64',
+}
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_manifest(cache_dir, manifest):
+    with open(os.path.join(cache_dir, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+
+def convert_csv(csv_path, parquet_path):
+    # Categorical columns are read as text first, so codes such as Código keep their format
+    # and empty columns get text categories like in every other partition
+    frame = pd.read_csv(csv_path, dtype={column: str for column in CATEGORICAL_COLUMNS})
+    for column, dtype in COLUMN_TYPES.items():
+        if column in frame:
+            frame[column] = frame[column].astype(dtype)
+    frame.to_parquet(parquet_path, index=False)
+
+def refresh_event_log_cache(directory, cache_dir=EVENT_LOG_CACHE):
+    # A file is converted again only when its size or mtime changed and its content hash
+    # differs from the cached one, partitions of removed files are dropped
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = read_manifest(cache_dir)
+    filenames = sorted(filename for filename in os.listdir(directory) if filename.endswith('.csv'))
+
+    converted = 0
+    for filename in filenames:
+        csv_path = os.path.join(directory, filename)
+        stat = os.stat(csv_path)
+        entry = manifest.get(filename)
+        parquet_path = os.path.join(cache_dir, os.path.splitext(filename)[0] + '.parquet')
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and os.path.exists(parquet_path):
+            continue
+        digest = file_hash(csv_path)
+        if not entry or entry['sha256'] != digest or not os.path.exists(parquet_path):
+            convert_csv(csv_path, parquet_path)
+            converted += 1
+        manifest[filename] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest,
+                              'partition': os.path.basename(parquet_path)}
+
+    for filename in set(manifest) - set(filenames):
+        parquet_path = os.path.join(cache_dir, manifest.pop(filename)['partition'])
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+
+    write_manifest(cache_dir, manifest)
+    print(f"Event log cache refreshed, {converted} of {len(filenames)} files converted.")
+    return [manifest[filename]['partition'] for filename in filenames]
+
+def concat_partitions(frames):
+    # Files may not share all columns, partitions are aligned on the union of their columns and
+    # a missing column is filled with NA of the type it has in the other partitions
+    columns = list(dict.fromkeys(column for frame in frames for column in frame.columns))
+    for column in columns:
+        dtype = next(frame[column].dtype for frame in frames if column in frame)
+        for frame in frames:
+            if column not in frame:
+                frame[column] = pd.Series(index=frame.index, dtype=dtype)
+    frames = [frame[columns] for frame in frames]
+    # Partitions have their own categories, they are unified so the columns stay categorical
+    for column in columns:
+        if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = union_categoricals([frame[column] for frame in frames]).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+def load_event_log(directory=None, columns=None, cache_dir=EVENT_LOG_CACHE, refresh=True):
+    # Event log as one DataFrame, restricted to the given columns
+    directory = directory or os.getenv('DIRECTORY_1')
+    if refresh:
+        partitions = refresh_event_log_cache(directory, cache_dir)
+    else:
+        partitions = sorted(entry['partition'] for entry in read_manifest(cache_dir).values())
+    frames = [pd.read_parquet(os.path.join(cache_dir, partition), columns=columns) for partition in partitions]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return concat_partitions(frames)